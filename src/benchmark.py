@@ -0,0 +1,285 @@
+"""
+Micro-benchmarks of the connect4 engine.
+
+Plays fixed-seed random games and scripted worst-case games through
+connect4 and VecConnect4 and reports moves and games per second, the
+latency distribution of each engine call and the memory each move
+allocates. Calls and classes an older engine does not have are left out,
+so results can be saved as JSON and compared with those of any commit.
+
+Usage:
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+
+from connect4 import connect4
+
+# Older engines have no batch environment or bitboards
+try:
+    from connect4 import VecConnect4
+except ImportError:
+    VecConnect4 = None
+try:
+    from connect4 import is_win
+except ImportError:
+    is_win = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+# Scripted games, columns played from the start
+SCRIPTED_GAMES = {
+    # Ends in a tie on the 42nd stone
+    "full_board_tie": "361313645534311043046626105524515600224220",
+    # Won on a diagonal with the 41st stone
+    "long_diagonal_win": "60050465016033014645625123645215121433432",
+}
+
+
+def legal_columns(game):
+    """
+    Get columns game can be played in, from its top row if it has no legal mask.
+    """
+    if hasattr(game, "legal"):
+        return [col for col in range(7) if game.legal[col]]
+    return [col for col in range(7) if not (game.p1_board[0][col] or game.p2_board[0][col])]
+
+
+def random_games(num_games, seed):
+    """
+    Play random games with a fixed seed and get their moves.
+    """
+    rng = random.Random(seed)
+    game = connect4()
+    games = []
+    for _ in range(num_games):
+        game.reset()
+        moves = []
+        while not game.terminal:
+            move = rng.choice(legal_columns(game))
+            game.apply_action(move)
+            moves.append(move)
+        games.append(moves)
+    return games
+
+
+def latency_stats(samples):
+    """
+    Summarize call latencies (seconds) in microseconds.
+    """
+    samples = np.array(samples) * 1e6
+    return {"mean_us": float(np.mean(samples)),
+            "p50_us": float(np.percentile(samples, 50)),
+            "p90_us": float(np.percentile(samples, 90)),
+            "p99_us": float(np.percentile(samples, 99)),
+            "max_us": float(np.max(samples)),
+            "calls": len(samples)}
+
+
+def bench_playouts(games, repeat):
+    """
+    Time replaying games through apply_action, best of repeat.
+    """
+    game = connect4()
+    num_moves = sum(len(moves) for moves in games)
+    best = float("inf")
+    for _ in range(repeat):
+        start = timer()
+        for moves in games:
+            game.reset()
+            for move in moves:
+                game.apply_action(move)
+        best = min(best, timer() - start)
+    return {"moves_per_sec": num_moves / best, "games_per_sec": len(games) / best}
+
+
+def bench_calls(games):
+    """
+    Time every engine call on its own over the moves of games, leaving out
+    the calls the engine does not have.
+    """
+    game = connect4()
+    has_bits = is_win is not None and hasattr(game, "p1_bits")
+    has_snapshot = hasattr(game, "snapshot") and hasattr(game, "restore")
+    latencies = dict((name, []) for name in
+                     ("reset", "apply_action", "pop", "snapshot", "restore", "p1_board", "is_win"))
+    for moves in games:
+        start = timer()
+        game.reset()
+        latencies["reset"].append(timer() - start)
+        for move in moves:
+            start = timer()
+            game.apply_action(move)
+            latencies["apply_action"].append(timer() - start)
+
+            start = timer()
+            game.p1_board
+            latencies["p1_board"].append(timer() - start)
+
+            if has_bits:
+                bits = game.p1_bits
+                start = timer()
+                is_win(bits)
+                latencies["is_win"].append(timer() - start)
+
+        if has_snapshot:
+            start = timer()
+            token = game.snapshot()
+            latencies["snapshot"].append(timer() - start)
+            start = timer()
+            game.restore(token)
+            latencies["restore"].append(timer() - start)
+
+        if hasattr(game, "pop"):
+            while game.moveNum > 1:
+                start = timer()
+                game.pop()
+                latencies["pop"].append(timer() - start)
+    return dict((name, latency_stats(samples)) for name, samples in latencies.items() if samples)
+
+
+def bench_scripted(repeat):
+    """
+    Time replaying the scripted worst-case games.
+    """
+    game = connect4()
+    results = {}
+    for name, moves in SCRIPTED_GAMES.items():
+        moves = [int(move) for move in moves]
+        latencies = []
+        for _ in range(repeat):
+            game.reset()
+            for move in moves:
+                start = timer()
+                game.apply_action(move)
+                latencies.append(timer() - start)
+        assert game.terminal
+        results[name] = latency_stats(latencies)
+        results[name]["moves_per_sec"] = 1e6 / results[name]["mean_us"]
+    return results
+
+
+def bench_vec(batch_sizes, steps, seed):
+    """
+    Time random steps of VecConnect4 at several batch sizes.
+    """
+    if VecConnect4 is None:
+        return None
+    rng = np.random.RandomState(seed)
+    results = {}
+    for num_games in batch_sizes:
+        env = VecConnect4(num_games)
+        actions = rng.randint(0, 7, size=[steps, num_games])
+        start = timer()
+        for step in range(steps):
+            env.step(actions[step])
+        elapsed = timer() - start
+        results[str(num_games)] = {"moves_per_sec": num_games * steps / elapsed,
+                                   "steps_per_sec": steps / elapsed}
+    return results
+
+
+def bench_allocations(games):
+    """
+    Measure the memory every apply_action call allocates, tracing only
+    during the call: the peak bytes it allocated, freed or not, and the
+    bytes it left allocated.
+    """
+    if tracemalloc is None:
+        return None
+    game = connect4()
+    allocated = []
+    retained = []
+    for moves in games:
+        game.reset()
+        for move in moves:
+            tracemalloc.start()
+            game.apply_action(move)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            allocated.append(peak)
+            retained.append(current)
+    return {"allocated_bytes_per_move": float(np.mean(allocated)),
+            "max_allocated_bytes": int(np.max(allocated)),
+            "allocating_moves": float(np.mean(np.array(allocated) > 0)),
+            "retained_bytes_per_move": float(np.mean(retained))}
+
+
+def git_commit():
+    """
+    Get the commit being benchmarked, if known.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, path=()):
+    """
+    Print the ratio of every rate in results to the one in baseline.
+    """
+    for name, value in sorted(results.items()):
+        if isinstance(value, dict):
+            if isinstance(baseline.get(name), dict):
+                compare(value, baseline[name], path + (name,))
+        elif name.endswith("_per_sec") and baseline.get(name):
+            print("%-50s %12.0f -> %12.0f  x%.2f" %
+                  ("/".join(path + (name,)), baseline[name], value, value / baseline[name]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the connect4 engine.")
+    parser.add_argument("--games", type=int, default=2000, help="Random games to play")
+    parser.add_argument("--seed", type=int, default=0, help="Random games seed")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeats of timed loops")
+    parser.add_argument("--batch_sizes", default="1,64,1024", help="VecConnect4 batch sizes")
+    parser.add_argument("--output", help="Save results to this JSON file")
+    parser.add_argument("--compare", help="Compare with results saved in this JSON file")
+    args = parser.parse_args()
+
+    games = random_games(args.games, args.seed)
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "time": time.time(),
+        "games": args.games,
+        "seed": args.seed,
+        "playouts": bench_playouts(games, args.repeat),
+        "calls": bench_calls(games),
+        "scripted": bench_scripted(args.repeat * 100),
+        "vec": bench_vec([int(size) for size in args.batch_sizes.split(",")], 200, args.seed),
+        "allocations": bench_allocations(games[:200]),
+    }
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark of Q network updates per second of asynchronous actor-learner
+threads against the single-threaded training loop.
+
+Every configuration plays self-play games from freshly initialized variables
+and updates the network after each one, as in training, for a fixed time.
+
+Usage:
+    python benchmark_learners.py --threads 1,2,4,8 --secs 20
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+import threading
+
+import tensorflow as tf
+
+import network
+from connect4 import connect4
+from feeder import BatchFeeder
+
+
+def bench_sync(session, graph_ops, feeder, secs):
+    """
+    Time the single-threaded loop: play a game, update with it, repeat.
+    """
+    q_nn, q_nn_update, s, e, actions, values, loss, batch_td, batch_i, target_sync = graph_ops
+    game = connect4()
+    steps = feeder.steps
+    episodes = 0
+    start = time.time()
+    while time.time() - start < secs:
+        moves, r_t, player = network.play_episode(session, graph_ops, game, network.epsilon_initial)
+        network.finish_episode(session, graph_ops, feeder, moves, r_t, player)
+        episodes += 1
+    elapsed = time.time() - start
+    return {"updates_per_sec": (feeder.steps - steps) / elapsed, "episodes_per_sec": episodes / elapsed}
+
+
+def bench_async(session, graph_ops, feeder, num_threads, secs):
+    """
+    Time num_threads actor-learner threads.
+    """
+    episode_counts = [0] * num_threads
+    stop = threading.Event()
+    steps = feeder.steps
+    start = time.time()
+    workers = network.start_actor_learners(session, graph_ops, feeder, None, episode_counts, stop)
+    time.sleep(secs)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    return {"updates_per_sec": (feeder.steps - steps) / elapsed,
+            "episodes_per_sec": sum(episode_counts) / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark asynchronous actor-learner threads.")
+    parser.add_argument("--threads", default="1,2,4,8", help="Numbers of actor-learner threads")
+    parser.add_argument("--secs", type=float, default=20., help="Seconds per configuration")
+    args = parser.parse_args()
+
+    with tf.Session() as session:
+        graph_ops, input_ops = network.build_graph()
+        feeder = BatchFeeder(session, input_ops, network.board_cols)
+        try:
+            session.run(tf.initialize_all_variables())
+            results = [("sync", bench_sync(session, graph_ops, feeder, args.secs))]
+            for num_threads in [int(n) for n in args.threads.split(",")]:
+                session.run(tf.initialize_all_variables())
+                results.append(("%d threads" % num_threads,
+                                bench_async(session, graph_ops, feeder, num_threads, args.secs)))
+        finally:
+            feeder.stop()
+
+    baseline = results[0][1]["updates_per_sec"]
+    for name, result in results:
+        print("%-12s %10.1f updates/s %10.1f episodes/s  x%.2f" %
+              (name, result["updates_per_sec"], result["episodes_per_sec"],
+               result["updates_per_sec"] / baseline))
+
+if __name__ == "__main__":
+    main()
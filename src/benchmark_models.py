@@ -0,0 +1,99 @@
+"""
+Benchmark of the forward and backward latency of the Q network
+architectures on CPU.
+
+Every architecture is built in a graph of its own with freshly initialized
+variables and timed on random states, the forward pass alone and the
+forward pass with the gradients of a squared error loss, at each batch size.
+
+Usage:
+    python benchmark_models.py --architectures mlp,conv,residual --batch_sizes 1,8,64,1024
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+
+import tensorflow as tf
+
+import network
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+
+def time_op(session, op, feed_dict, repeat):
+    """
+    Time op, median of repeat runs after a warm-up one, in seconds.
+    """
+    session.run(op, feed_dict=feed_dict)
+    samples = []
+    for _ in range(repeat):
+        start = timer()
+        session.run(op, feed_dict=feed_dict)
+        samples.append(timer() - start)
+    return float(np.median(samples))
+
+
+def bench_architecture(architecture, batch_sizes, repeat, threads):
+    """
+    Time forward and backward passes of architecture at every batch size.
+    Returns its number of parameters and (batch size, forward, backward) times.
+    """
+    network.architecture = architecture
+    config = tf.ConfigProto(device_count={'GPU': 0},
+                            intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+    with tf.Graph().as_default(), tf.Session(config=config) as session:
+        s = tf.placeholder(tf.float32, [None, network.board_rows, network.board_cols, 2])
+        y = tf.placeholder(tf.float32, [None, network.board_cols])
+        q = network.q_network(s)
+        variables = tf.trainable_variables()
+        gradients = tf.gradients(tf.reduce_mean(tf.square(y - q)), variables)
+        session.run(tf.initialize_all_variables())
+        num_params = sum(int(np.prod(v.get_shape().as_list())) for v in variables)
+
+        rng = np.random.RandomState(0)
+        results = []
+        for batch_size in batch_sizes:
+            states = (rng.randint(3, size=[batch_size, network.board_rows, network.board_cols, 1]) ==
+                      np.arange(1, 3)).astype(np.float32)
+            targets = rng.randn(batch_size, network.board_cols).astype(np.float32)
+            forward = time_op(session, q, {s: states}, repeat)
+            backward = time_op(session, gradients, {s: states, y: targets}, repeat)
+            results.append((batch_size, forward, backward))
+    return num_params, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Q network architectures.")
+    parser.add_argument("--architectures", default="mlp,conv,residual", help="Architectures to time")
+    parser.add_argument("--batch_sizes", default="1,2,4,8,16,32,64,128,256,512,1024",
+                        help="Batch sizes to time")
+    parser.add_argument("--repeat", type=int, default=50, help="Runs per measurement")
+    parser.add_argument("--threads", type=int, default=0, help="TensorFlow CPU threads, 0 for all")
+    parser.add_argument("--conv_filters", type=int, default=network.conv_filters,
+                        help="Number of filters per convolution")
+    parser.add_argument("--conv_layers", type=int, default=network.conv_layers,
+                        help="Number of convolutions or residual blocks")
+    args = parser.parse_args()
+
+    network.conv_filters = args.conv_filters
+    network.conv_layers = args.conv_layers
+    batch_sizes = [int(n) for n in args.batch_sizes.split(",")]
+
+    print("%-10s %10s %6s %14s %14s %14s" % ("model", "params", "batch", "forward ms", "backward ms",
+                                              "backward us/ex"))
+    for architecture in args.architectures.split(","):
+        num_params, results = bench_architecture(architecture, batch_sizes, args.repeat, args.threads)
+        for batch_size, forward, backward in results:
+            print("%-10s %10d %6d %14.3f %14.3f %14.2f" %
+                  (architecture, num_params, batch_size, forward * 1e3, backward * 1e3,
+                   backward * 1e6 / batch_size))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+import time
+import threading
+
+import tensorflow as tf
+
+
+class CheckpointManager(object):
+    """
+    Checkpoints written on a background thread from in-memory snapshots.
+
+    Variable values are fetched in one session.run and handed to a writer
+    thread, which saves them through a CPU copy of the variables in a graph
+    of its own, so training goes on during disk writes. Checkpoints are due
+    every `episodes` episodes and/or every `secs` seconds, the model with the
+    best metric so far is kept apart, and the meta graph is written once.
+    While a write is in progress only the latest snapshot waits for it.
+    """
+    def __init__(self, session, saver, variables, save_dir, episodes=100, secs=0,
+                 max_to_keep=5, lower_is_better=True):
+        self.session = session
+        self.variables = variables
+        self.save_dir = save_dir
+        self.episodes = episodes
+        self.secs = secs
+        self.lower_is_better = lower_is_better
+        self.last_episode = 0
+        self.last_time = time.time()
+        self.best_metric = None
+
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        tf.train.export_meta_graph(filename=os.path.join(save_dir, "checkpoint.meta"),
+                                   graph_def=session.graph.as_graph_def(),
+                                   saver_def=saver.as_saver_def())
+
+        # Copy of the variables, same names, to write snapshots from
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf.device("/cpu:0"):
+            self.placeholders = []
+            assign_ops = []
+            copies = []
+            for v in variables:
+                shape = v.get_shape()
+                dtype = v.dtype.base_dtype
+                copy = tf.Variable(tf.zeros(shape, dtype), name=v.op.name, trainable=False)
+                value = tf.placeholder(dtype, shape)
+                assign_ops.append(copy.assign(value))
+                self.placeholders.append(value)
+                copies.append(copy)
+            self.assign_op = tf.group(*assign_ops)
+            self.saver = tf.train.Saver(copies, max_to_keep=max_to_keep)
+            self.best_saver = tf.train.Saver(copies, max_to_keep=1)
+            self.writer_session = tf.Session(graph=self.graph)
+            self.writer_session.run(tf.initialize_all_variables())
+
+        # Latest snapshots waiting for the writer, (values, episode) or None
+        self.pending = None
+        self.pending_best = None
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def due(self, episode_num):
+        """
+        Check a checkpoint is due at episode_num.
+        """
+        if self.episodes > 0 and episode_num - self.last_episode >= self.episodes:
+            return True
+        return self.secs > 0 and time.time() - self.last_time >= self.secs
+
+    def maybe_save(self, episode_num):
+        """
+        Snapshot variables for a checkpoint if one is due.
+        """
+        if not self.due(episode_num):
+            return False
+        self.last_episode = episode_num
+        self.last_time = time.time()
+        values = self.session.run(self.variables)
+        with self.condition:
+            self.pending = (values, episode_num)
+            self.condition.notify()
+        return True
+
+    def maybe_save_best(self, episode_num, metric):
+        """
+        Snapshot variables as the best model if metric beats the best so far.
+        """
+        if metric != metric:
+            # NaN
+            return False
+        if self.best_metric is not None and (metric >= self.best_metric if self.lower_is_better
+                                             else metric <= self.best_metric):
+            return False
+        self.best_metric = metric
+        values = self.session.run(self.variables)
+        with self.condition:
+            self.pending_best = (values, episode_num)
+            self.condition.notify()
+        return True
+
+    def close(self):
+        """
+        Write waiting snapshots and stop the writer thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.writer_session.close()
+
+    def _write(self, saver, snapshot, name, latest_filename):
+        values, episode_num = snapshot
+        self.writer_session.run(self.assign_op, feed_dict=dict(zip(self.placeholders, values)))
+        saver.save(self.writer_session, os.path.join(self.save_dir, name), global_step=episode_num,
+                   latest_filename=latest_filename, write_meta_graph=False)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.pending_best is None and not self.closed:
+                    self.condition.wait()
+                snapshot, self.pending = self.pending, None
+                best, self.pending_best = self.pending_best, None
+                if snapshot is None and best is None:
+                    return
+            if snapshot is not None:
+                self._write(self.saver, snapshot, "checkpoint", None)
+            if best is not None:
+                self._write(self.best_saver, best, "best", "best_checkpoint")
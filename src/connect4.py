@@ -1,19 +1,192 @@
+import random
+
 import numpy as np
 
-class connect4:
+# Board size
+ROWS = 6
+COLS = 7
+
+# Bits per column in a bitboard: one bit per row plus an empty sentinel bit on
+# top, so shifts never carry a line over from one column into the next.
+#
+#   5 12 19 26 33 40 47   <- sentinel row
+#   4 11 18 25 32 39 46   <- row 0 (top)
+#   3 10 17 24 31 38 45
+#   2  9 16 23 30 37 44
+#   1  8 15 22 29 36 43
+#   0  7 14 21 28 35 42   <- row 5 (bottom)
+#   (bit 6 of every column is the sentinel)
+H1 = ROWS + 1
+
+# Bit of the bottom cell of every column
+BOTTOM_MASK = sum(1 << (col * H1) for col in range(COLS))
+# Bits of every playable cell
+BOARD_MASK = BOTTOM_MASK * ((1 << ROWS) - 1)
+
+# Bit of the stone played in each column at each height
+MOVE_BITS = [[1 << (col * H1 + height) for height in range(ROWS)] for col in range(COLS)]
+
+# Bit of every cell in the [row, col] layout used by the network, row 0 on top
+CELL_BITS = np.array([[1 << (col * H1 + ROWS - 1 - row) for col in range(COLS)]
+                      for row in range(ROWS)], dtype=np.uint64)
+
+
+# Zobrist keys of a stone of each player on each bit index, fixed so hashes
+# are comparable across runs
+_zobrist_random = random.Random(4)
+P1_ZOBRIST = [_zobrist_random.getrandbits(64) for _ in range(COLS * H1)]
+P2_ZOBRIST = [_zobrist_random.getrandbits(64) for _ in range(COLS * H1)]
+
+# Bit index of each cell's mirror image across the center column
+MIRROR_CELLS = [(COLS - 1 - cell // H1) * H1 + cell % H1 for cell in range(COLS * H1)]
+# Zobrist keys of the mirror image of each stone, for the mirrored position's hash
+P1_MIRROR_ZOBRIST = [P1_ZOBRIST[MIRROR_CELLS[cell]] for cell in range(COLS * H1)]
+P2_MIRROR_ZOBRIST = [P2_ZOBRIST[MIRROR_CELLS[cell]] for cell in range(COLS * H1)]
+
+_EMPTY_HEIGHTS = bytes(bytearray(COLS))
+
+
+def is_win(bits):
+    """
+    Check a player's bitboard for four stones in a row.
+    """
+    # vertical, horizontal, up-right and down-right diagonals
+    for shift in (1, H1, H1 + 1, H1 - 1):
+        pairs = bits & (bits >> shift)
+        if pairs & (pairs >> (2 * shift)):
+            return True
+    return False
+
+
+def zobrist(bits, keys):
+    """
+    XOR together the Zobrist keys of the stones of a bitboard.
+    """
+    key = 0
+    while bits:
+        low = bits & -bits
+        key ^= keys[low.bit_length() - 1]
+        bits ^= low
+    return key
+
+
+def mirror_bits(bits):
+    """
+    Mirror a bitboard left to right.
+    """
+    mirrored = 0
+    for col in range(COLS):
+        mirrored |= ((bits >> (col * H1)) & ((1 << H1) - 1)) << ((COLS - 1 - col) * H1)
+    return mirrored
+
+
+def bits_to_plane(bits):
+    """
+    Expand a bitboard into a [row, col] bool plane.
+    """
+    return (CELL_BITS & np.uint64(bits)) != 0
+
+
+def create_state(move_x, sx, so):
+    """
+    Create full [row, col, channel] state from X and O states, the player to
+    move in channel 0.
+    """
+    return np.stack([sx, so] if move_x else [so, sx], axis=-1).astype(np.float32)
+
+
+def four_in_a_row(planes):
+    """
+    Check a batch of [row, col] bool planes for four stones in a row.
+    """
+    # Equivalent to convolving with the four line kernels and testing for 4:
+    # AND together the four shifted views along each direction.
+    p = planes
+    horizontal = p[:, :, :-3] & p[:, :, 1:-2] & p[:, :, 2:-1] & p[:, :, 3:]
+    vertical = p[:, :-3] & p[:, 1:-2] & p[:, 2:-1] & p[:, 3:]
+    diagonal = p[:, :-3, :-3] & p[:, 1:-2, 1:-2] & p[:, 2:-1, 2:-1] & p[:, 3:, 3:]
+    antidiagonal = p[:, 3:, :-3] & p[:, 2:-1, 1:-2] & p[:, 1:-2, 2:-1] & p[:, :-3, 3:]
+    return (horizontal.any(axis=(1, 2)) | vertical.any(axis=(1, 2)) |
+            diagonal.any(axis=(1, 2)) | antidiagonal.any(axis=(1, 2)))
+
+
+class connect4(object):
+    """
+    Connect4 game on two bitboards.
+
+    apply_action keeps the bitboards, column heights, move stack, legal mask
+    and Zobrist hashes up to date and checks the mover's bitboard for a win;
+    bool planes are derived from the bitboards when asked for.
+    """
+    # Fixed set of fields so millions of games stay small
+    __slots__ = ('p1_bits', 'p2_bits', 'heights', 'moves', 'p1_turn', 'moveNum', 'terminal',
+                 'legal', 'hash', 'mirror_hash', '_p1_board', '_p1_board_bits', '_p2_board', '_p2_board_bits')
+
     def __init__(self):
+        # Number of stones in each column
+        self.heights = bytearray(COLS)
+        # Columns played so far, the first moveNum - 1 entries are valid
+        self.moves = bytearray(ROWS * COLS)
+        # Columns that still take a stone, only changes when a column fills or empties
+        self.legal = np.ones(COLS, dtype=np.bool_)
+        # Bool planes are only built when asked for, for the bitboard they were built from
+        self._p1_board = self._p2_board = None
+        self._p1_board_bits = self._p2_board_bits = None
         self.reset()
 
     def reset(self):
-        self.board = [[0]*7 for _ in xrange(6)]
-        self.p1_board = np.empty([6,7], dtype=np.bool)
-        self.p2_board = np.empty_like(self.p1_board)
-        self.p1_board[:] = False
-        self.p2_board[:] = False
+        # One bitboard per player
+        self.p1_bits = 0
+        self.p2_bits = 0
+        # Zobrist hashes of the position and of its mirror image, one XOR per move
+        self.hash = 0
+        self.mirror_hash = 0
+        # Counters are cleared in place
+        self.heights[:] = _EMPTY_HEIGHTS
+        self.legal[:] = True
         self.p1_turn = True
         self.moveNum = 1
         self.terminal = False
 
+    def snapshot(self):
+        """
+        Get an immutable token of the game: the columns played so far.
+        """
+        return bytes(self.moves[:self.moveNum - 1])
+
+    def restore(self, token):
+        """
+        Rebuild the game saved by snapshot(), move stack included.
+        """
+        self.reset()
+        for move in bytearray(token):
+            self.apply_action(move)
+
+    @property
+    def p1_board(self):
+        if self._p1_board_bits != self.p1_bits:
+            self._p1_board = bits_to_plane(self.p1_bits)
+            self._p1_board_bits = self.p1_bits
+        return self._p1_board
+
+    @property
+    def p2_board(self):
+        if self._p2_board_bits != self.p2_bits:
+            self._p2_board = bits_to_plane(self.p2_bits)
+            self._p2_board_bits = self.p2_bits
+        return self._p2_board
+
+    def canonical_hash(self):
+        """
+        Get the smaller of the position's and its mirror image's hashes, and
+        whether it is the mirror image's.
+        """
+        key = self.hash
+        mirror_key = self.mirror_hash
+        if mirror_key < key:
+            return mirror_key, True
+        return key, False
+
     def getPlayersMove(self):
         move = -1
         while(move < 0) or (move > 6):
@@ -25,134 +198,187 @@ class connect4:
         if(move < 0) or (move > 6):
             print("invalid move :(( ", move)
             return -1, self.terminal
+        heights = self.heights
+        height = heights[move]
+        if height == ROWS:
+            print("invalid move :( ", move)
+            self.printBoard()
+            return -1, self.terminal
+
+        heights[move] = height + 1
+        if height == ROWS - 1:
+            self.legal[move] = False
+        moveNum = self.moveNum
+        self.moves[moveNum - 1] = move
+        self.moveNum = moveNum + 1
+        cell = move * H1 + height
         if self.p1_turn:
-            currentPlayer = 1
+            bits = self.p1_bits = self.p1_bits | MOVE_BITS[move][height]
+            self.hash ^= P1_ZOBRIST[cell]
+            self.mirror_hash ^= P1_MIRROR_ZOBRIST[cell]
+            self.p1_turn = False
         else:
-            currentPlayer = -1
-        row = 5
-        while(row > -1):
-            if(self.board[row][move] == 0):
-                self.board[row][move] = currentPlayer
-                self.moveNum += 1
-                self.p1_turn = not self.p1_turn
-                if(currentPlayer == 1):
-                    self.p1_board[row][move] = True
-                else:
-                    self.p2_board[row][move] = True
-                if self.checkWin(row, move, currentPlayer):
-                    self.terminal = True
-                    #if currentPlayer:
-                    #    print("Player 1 won!")
-                    #else:
-                    #    print("Player 2 won!")
-                    return 1, self.terminal
-                if self.checkTie():
-                    self.terminal = True
-                    return 0, self.terminal
-                return 0, self.terminal
-            row -= 1
-        print("invalid move :( ", move)
-        self.printBoard()
-        return -1, self.terminal
+            bits = self.p2_bits = self.p2_bits | MOVE_BITS[move][height]
+            self.hash ^= P2_ZOBRIST[cell]
+            self.mirror_hash ^= P2_MIRROR_ZOBRIST[cell]
+            self.p1_turn = True
+
+        # The mover has four stones from the 7th move on, is_win() unrolled
+        # with literal shifts, this is the hottest call of self-play
+        if moveNum >= 7:
+            pairs = bits & (bits >> 1)
+            if pairs & (pairs >> 2):
+                self.terminal = True
+                return 1, True
+            pairs = bits & (bits >> 7)
+            if pairs & (pairs >> 14):
+                self.terminal = True
+                return 1, True
+            pairs = bits & (bits >> 8)
+            if pairs & (pairs >> 16):
+                self.terminal = True
+                return 1, True
+            pairs = bits & (bits >> 6)
+            if pairs & (pairs >> 12):
+                self.terminal = True
+                return 1, True
+            if moveNum == ROWS * COLS:
+                # board full
+                self.terminal = True
+        return 0, self.terminal
+
+    def push(self, move):
+        """
+        Play move so that pop() can take it back. Raises ValueError, leaving
+        the game as it was, if the game is over or the column is full.
+        """
+        if self.terminal:
+            raise ValueError("game is over")
+        if not 0 <= move < COLS or self.heights[move] == ROWS:
+            raise ValueError("invalid move: %r" % (move,))
+        return self.apply_action(move)
+
+    def pop(self):
+        """
+        Take back the last move and return its column.
+        """
+        if self.moveNum == 1:
+            raise IndexError("no move to take back")
+        move = self.moves[self.moveNum - 2]
+        self.undo_action(move)
+        return move
+
+    def undo_action(self, move):
+        """
+        Take back the last move, which was played in column [move].
+        """
+        height = self.heights[move] - 1
+        self.heights[move] = height
+        self.legal[move] = True
+        cell = move * H1 + height
+        self.p1_turn = not self.p1_turn
+        if self.p1_turn:
+            self.p1_bits ^= 1 << cell
+            self.hash ^= P1_ZOBRIST[cell]
+            self.mirror_hash ^= P1_MIRROR_ZOBRIST[cell]
+        else:
+            self.p2_bits ^= 1 << cell
+            self.hash ^= P2_ZOBRIST[cell]
+            self.mirror_hash ^= P2_MIRROR_ZOBRIST[cell]
+        self.moveNum -= 1
+        # apply_action() plays on after the end, so the previous position
+        # may have been over too
+        self.terminal = is_win(self.p1_bits) or is_win(self.p2_bits) or self.checkTie()
 
     def printBoard(self):
-        boardString = ""
-        for row in range(6):
-            for col in range(7):
-                if(self.board[row][col] == -1):
-                    boardString = boardString[:len(boardString)-1]
-                boardString += str(self.board[row][col]) + "  "
-            print(boardString)
+        for row in range(ROWS):
             boardString = ""
+            for col in range(COLS):
+                bit = 1 << (col * H1 + ROWS - 1 - row)
+                if self.p1_bits & bit:
+                    boardString += "1  "
+                elif self.p2_bits & bit:
+                    # shift left so the minus sign doesn't misalign the column
+                    boardString = boardString[:len(boardString)-1] + "-1  "
+                else:
+                    boardString += "0  "
+            print(boardString)
 
     def checkTie(self):
-        if self.moveNum >= 42:
-            return True
+        return self.moveNum > ROWS * COLS
 
-    def checkWin(self, row, col, currentPlayer):
-        score = 0
-        lastMove = (row,col)
-        #downward check
-        while(row < 6):
-            if(self.board[row][col] == currentPlayer):
-                score += 1
-            else:
-                break
-            row += 1
-        if(score > 3):
-            self.terminal = True
-            return True
-        
-        score = 0
-        row = lastMove[0]
-
-        #horizontal check
-        while(col > -1):
-            if(self.board[row][col] == currentPlayer):
-                score += 1
-            else:
-                break
-            col -= 1
-        #here we set col 1 past where the last move was made so we don't count it twice
-        col = lastMove[1] + 1
-        while(col < 7):
-            if(self.board[row][col] == currentPlayer):
-                score += 1
-            else:
-                break
-            col += 1
-        if(score > 3):
-            self.terminal = True
-            return True
+class VecConnect4(object):
+    """
+    Batch of connect4 games stepped together.
 
-        score = 0
-        col = lastMove[1]
-        #up-left, down-right diagonal check
-        while(row > -1 and col > -1):
-            if(self.board[row][col] == currentPlayer):
-                score += 1
-            else:
-                break
-            col -= 1
-            row -= 1
-        row = lastMove[0] + 1
-        col = lastMove[1] + 1
-        while(row < 6 and col < 7):
-            if(self.board[row][col] == currentPlayer):
-                score += 1
-            else:
-                break
-            col += 1
-            row += 1
-        if(score > 3):
-            self.terminal = True
-            return True
+    Boards are stacked as [game, player, row, col] with player 0 moving first.
+    A game is reset as soon as it ends, so every step plays all games.
+    """
+    def __init__(self, num_games):
+        self.num_games = num_games
+        self.boards = np.zeros([num_games, 2, ROWS, COLS], dtype=np.bool_)
+        # Number of stones in each column
+        self.heights = np.zeros([num_games, COLS], dtype=np.int8)
+        # Mask of the columns that still take a stone
+        self.legal = np.ones([num_games, COLS], dtype=np.bool_)
+        self.p1_turn = np.ones(num_games, dtype=np.bool_)
+        self.moveNum = np.ones(num_games, dtype=np.int32)
+        self._games = np.arange(num_games)
 
-        score = 0
-        row = lastMove[0]
-        col = lastMove[1]
-        #up-right, down-left diagonal check
-        while(row > -1 and col < 7):
-            if(self.board[row][col] == currentPlayer):
-                score += 1
-            else:
-                break
-            col += 1
-            row -= 1
-        row = lastMove[0] + 1
-        col = lastMove[1] - 1
-        while(row < 6 and col > -1):
-            if(self.board[row][col] == currentPlayer):
-                score += 1
-            else:
-                break
-            col -= 1
-            row += 1
-        if(score > 3):
-            self.terminal = True
-            return True
+    def reset(self, games=None):
+        """
+        Reset the given game indices, or all games.
+        """
+        if games is None:
+            games = slice(None)
+        self.boards[games] = False
+        self.heights[games] = 0
+        self.legal[games] = True
+        self.p1_turn[games] = True
+        self.moveNum[games] = 1
+
+    def observe(self):
+        """
+        States of all games in create_state() layout, player to move in
+        channel 0.
+        """
+        mover = (~self.p1_turn).astype(np.intp)
+        states = np.empty([self.num_games, ROWS, COLS, 2], dtype=np.float32)
+        states[..., 0] = self.boards[self._games, mover]
+        states[..., 1] = self.boards[self._games, 1 - mover]
+        return states
+
+    def step(self, actions):
+        """
+        Apply one action per game.
+
+        Returns the next states, the rewards of the players who moved and the
+        terminal flags. Finished games are already reset in the returned
+        states. Like connect4.apply_action(), an invalid move is rewarded -1
+        and leaves its game untouched.
+        """
+        actions = np.asarray(actions, dtype=np.intp)
+        columns = np.clip(actions, 0, COLS - 1)
+        valid = (actions == columns) & self.legal[self._games, columns]
+
+        games = self._games[valid]
+        columns = columns[valid]
+        players = (~self.p1_turn[valid]).astype(np.intp)
+        rows = ROWS - 1 - self.heights[games, columns]
+        self.boards[games, players, rows, columns] = True
+        self.heights[games, columns] += 1
+        self.legal[games, columns] = self.heights[games, columns] < ROWS
+        self.moveNum[games] += 1
+        self.p1_turn[games] = ~self.p1_turn[games]
+
+        win = four_in_a_row(self.boards[games, players])
+        rewards = np.full(self.num_games, -1, dtype=np.float32)
+        rewards[valid] = win
+        terminals = np.zeros(self.num_games, dtype=np.bool_)
+        terminals[valid] = win | (self.moveNum[games] > ROWS * COLS)
 
-        return False
+        self.reset(np.flatnonzero(terminals))
+        return self.observe(), rewards, terminals
 
 #def main():
 #    test = connect4()
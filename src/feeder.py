@@ -0,0 +1,128 @@
+import time
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+import tensorflow as tf
+
+from replay import PrioritizedReplayMemory
+
+
+class BatchFeeder(object):
+    """
+    Background thread filling the graph's input queue with update batches,
+    so preparing a batch overlaps with the training step on the previous one.
+
+    Without replay memory it enqueues the batches put by the learner, in
+    order, and the learner trains on them one episode late (see due()), so
+    an episode's batches are staged while the previous ones train. With
+    replay memory it keeps sampling minibatches from it.
+    """
+    def __init__(self, session, input_ops, num_actions, memory=None, batch_size=64):
+        self.session = session
+        self.input_ops = input_ops
+        self.num_actions = num_actions
+        self.memory = memory
+        self.batch_size = batch_size
+        # Guards the replay memory, shared with the learner
+        self.lock = threading.Lock()
+        # Number of batches trained on
+        self.steps = 0
+        # Number of batches put and not yet claimed for training
+        self.queued = 0
+        self.pending = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, batch_s, batch_a, batch_r, batch_next, batch_d):
+        """
+        Queue an (s, a, r, s_next, d) batch for one training step.
+        """
+        with self.lock:
+            self.queued += 1
+        self.pending.put((batch_s, batch_a, batch_r, batch_next, batch_d,
+                          np.ones(len(batch_r), dtype=np.float32),
+                          np.full(len(batch_r), -1, dtype=np.int32)))
+
+    def due(self, keep):
+        """
+        Claim the batches put before the latest keep ones, returns how many
+        training steps to run on them.
+        """
+        with self.lock:
+            count = max(self.queued - keep, 0)
+            self.queued -= count
+        return count
+
+    def remember(self, batch_s, batch_a, batch_r, batch_next, batch_d):
+        """
+        Add an (s, a, r, s_next, d) batch to replay memory.
+        """
+        with self.lock:
+            self.memory.add_batch(s=batch_s, a=np.argmax(batch_a, axis=1), r=batch_r,
+                                  s_next=batch_next, d=batch_d)
+
+    def ready(self):
+        """
+        Check replay memory holds enough transitions to sample a minibatch.
+        """
+        with self.lock:
+            return len(self.memory) >= self.batch_size
+
+    def trained(self, indices, errors):
+        """
+        Count a batch trained on and reprioritize its sampled transitions by
+        their TD errors, if prioritized.
+        """
+        self.steps += 1
+        if isinstance(self.memory, PrioritizedReplayMemory):
+            with self.lock:
+                self.memory.update_priorities(indices, errors)
+
+    def stop(self):
+        """
+        Close the input queue and wait for the thread to finish.
+        """
+        enqueue, close, s, a, r, s_next, d, w, i = self.input_ops
+        self.stopped.set()
+        self.session.run(close)
+        self.thread.join()
+
+    def _sample(self):
+        with self.lock:
+            if len(self.memory) < self.batch_size:
+                return None
+            if isinstance(self.memory, PrioritizedReplayMemory):
+                indices, batch, batch_w = self.memory.sample(self.batch_size)
+            else:
+                indices, batch = self.memory.sample(self.batch_size)
+                batch_w = np.ones(self.batch_size, dtype=np.float32)
+        batch_a = np.eye(self.num_actions, dtype=np.float32)[batch["a"]]
+        return (batch["s"].astype(np.float32), batch_a, batch["r"], batch["s_next"].astype(np.float32),
+                batch["d"], batch_w, indices.astype(np.int32))
+
+    def _run(self):
+        enqueue, close, s, a, r, s_next, d, w, i = self.input_ops
+        try:
+            while not self.stopped.is_set():
+                if self.memory is None:
+                    try:
+                        batch = self.pending.get(timeout=.1)
+                    except queue.Empty:
+                        continue
+                else:
+                    batch = self._sample()
+                    if batch is None:
+                        time.sleep(.01)
+                        continue
+                self.session.run(enqueue, feed_dict=dict(zip((s, a, r, s_next, d, w, i), batch)))
+        except (tf.errors.CancelledError, tf.errors.AbortedError):
+            # Input queue closed
+            pass
@@ -0,0 +1,139 @@
+import time
+import random
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+import tensorflow as tf
+
+
+class RunningStat(object):
+    """
+    Constant-memory mean, min, max and percentiles of a stream of values.
+
+    Percentiles come from a uniform reservoir sample of at most
+    reservoir_size values.
+    """
+    def __init__(self, reservoir_size=1024, rng=random):
+        self.count = 0
+        self.mean = 0.
+        self.min = float("inf")
+        self.max = -float("inf")
+        self.reservoir = np.empty(reservoir_size)
+        self.rng = rng
+
+    def add(self, value):
+        self.count += 1
+        self.mean += (value - self.mean) / self.count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if self.count <= len(self.reservoir):
+            self.reservoir[self.count - 1] = value
+        else:
+            index = self.rng.randrange(self.count)
+            if index < len(self.reservoir):
+                self.reservoir[index] = value
+
+    def percentiles(self, qs):
+        return np.percentile(self.reservoir[:min(self.count, len(self.reservoir))], qs)
+
+
+class Metrics(object):
+    """
+    Streaming aggregates of training metrics written to TensorBoard by a
+    background thread.
+
+    Values added between two flushes are summarized as their mean, min, max
+    and percentiles, one point per flush, so the event file grows with the
+    number of flushes, not of values. Flushes are due every `episodes`
+    episodes and/or every `secs` seconds.
+    """
+    def __init__(self, logdir, graph=None, episodes=100, secs=0, reservoir_size=1024,
+                 percentiles=(10, 50, 90)):
+        self.writer = tf.train.SummaryWriter(logdir, graph)
+        self.episodes = episodes
+        self.secs = secs
+        self.reservoir_size = reservoir_size
+        self.percentiles = percentiles
+        self.last_episode = 0
+        self.last_time = time.time()
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, name, value):
+        """
+        Add value to metric name, NaNs are ignored.
+        """
+        if value != value:
+            return
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = RunningStat(self.reservoir_size)
+            stat.add(value)
+
+    def due(self, episode_num):
+        """
+        Check a flush is due at episode_num.
+        """
+        if self.episodes > 0 and episode_num - self.last_episode >= self.episodes:
+            return True
+        return self.secs > 0 and time.time() - self.last_time >= self.secs
+
+    def maybe_flush(self, episode_num):
+        """
+        Flush metrics if due, returns their means or None.
+        """
+        if not self.due(episode_num):
+            return None
+        return self.flush(episode_num)
+
+    def flush(self, episode_num):
+        """
+        Hand metrics aggregated since the last flush, and the episode rate,
+        to the writer thread and start new aggregates. Returns their means.
+        """
+        now = time.time()
+        episodes_per_sec = (episode_num - self.last_episode) / max(now - self.last_time, 1e-9)
+        self.last_episode = episode_num
+        self.last_time = now
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        self.pending.put((stats, episodes_per_sec, episode_num))
+        means = dict((name, stat.mean) for name, stat in stats.items())
+        means["Episodes/s"] = episodes_per_sec
+        return means
+
+    def close(self):
+        """
+        Write flushed metrics and stop the writer thread.
+        """
+        self.pending.put(None)
+        self.thread.join()
+        self.writer.close()
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            stats, episodes_per_sec, episode_num = item
+            values = [tf.Summary.Value(tag="Episodes/s", simple_value=episodes_per_sec)]
+            for name, stat in sorted(stats.items()):
+                values.append(tf.Summary.Value(tag=name, simple_value=stat.mean))
+                values.append(tf.Summary.Value(tag=name + "/min", simple_value=stat.min))
+                values.append(tf.Summary.Value(tag=name + "/max", simple_value=stat.max))
+                for q, value in zip(self.percentiles, stat.percentiles(self.percentiles)):
+                    values.append(tf.Summary.Value(tag="%s/p%d" % (name, q), simple_value=value))
+            self.writer.add_summary(tf.Summary(value=values), episode_num)
@@ -20,7 +20,17 @@ from __future__ import print_function
 
 import time
 import random
-from connect4 import connect4
+import threading
+import multiprocessing
+from connect4 import connect4, VecConnect4, create_state
+from numpy_network import choose_action
+from play import play_versus_network
+from replay import ReplayMemory, PrioritizedReplayMemory
+from feeder import BatchFeeder
+from checkpoints import CheckpointManager
+from metrics import Metrics
+from shared_episodes import SharedEpisodes
+from returns import nstep_returns, nstep_targets, one_hot
 
 import colorama
 from colorama import Fore, Back, Style
@@ -36,6 +46,10 @@ try:
     xrange
 except:
     xrange = range
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # Board size
 board_rows = 6
@@ -54,9 +68,22 @@ REWARD_ACTION = 0.
 # Hidden layer size
 hidden_layer_size = 50
 
+# Q network architecture: "mlp", "conv" or "residual"
+architecture = "mlp"
+# Number of filters of each convolution of the conv and residual towers
+conv_filters = 32
+# Number of convolutions of the conv tower, residual blocks of the residual tower
+conv_layers = 3
+
 # Reward discount rate
 gamma = 0.8
 
+# Number of a player's moves its Q targets look ahead before bootstrapping
+n_step = 1
+
+# Number of updates between target network syncs, 0 to bootstrap on the Q values seen while acting
+target_interval = 0
+
 # Initial exploration rate
 epsilon_initial = 1.0
 # Final exploration rate
@@ -72,10 +99,46 @@ episode_max = 100000000
 
 # Number of training episodes to accumulate stats
 episode_stats = 100
+# Number of seconds to accumulate stats, 0 to only flush them every episode_stats episodes
+stats_secs = 0
+# Number of values per stat kept to estimate its percentiles
+stats_reservoir = 1024
 
 # Toggle playing against the network
 self_play = False
 
+# Number of self-play games advanced in lockstep, 0 to play one game at a time
+lockstep_games = 0
+
+# Number of self-play actor processes feeding the learner, 0 to train in one process
+actors = 0
+
+# Number of asynchronous actor-learner threads, 0 to train in one loop
+threads = 0
+
+# Final exploration rates of actor-learner threads and their probabilities
+THREAD_EPSILONS_FINAL = [.1, .01, .5]
+THREAD_EPSILONS_PROBS = [.4, .3, .3]
+
+# Number of learner updates between weights broadcasts to actors
+weights_interval = 20
+
+# Replay memory capacity in transitions, 0 to train on each episode once as it ends
+replay_capacity = 0
+# Number of transitions per replay minibatch
+replay_batch_size = 64
+# Number of replay minibatch updates per finished episode
+replay_updates = 2
+# Toggle sampling replay transitions in proportion to their TD errors
+prioritized_replay = False
+# Prioritization exponent
+replay_alpha = .6
+# Importance sampling exponent
+replay_beta = .4
+
+# Number of update batches staged in the graph's input queue
+input_queue_size = 4
+
 # Run name for tensorboard
 run_name = "%s" % int(time.time())
 
@@ -84,6 +147,11 @@ summary_dir = 'summaries'
 
 save_dir = 'checkpoints'
 
+# Number of episodes between checkpoints, 0 to only save every checkpoint_secs
+checkpoint_episodes = 100
+# Number of seconds between checkpoints, 0 to only save every checkpoint_episodes
+checkpoint_secs = 0
+
 def dump_board(sx, so, move_index=None, win_indices=None, q=None):
     """
     Dump board state to the terminal.
@@ -120,240 +188,503 @@ def dump_board(sx, so, move_index=None, win_indices=None, q=None):
     print()
 
 
-def playVersesNetwork(session, graph_ops, saver):
-    # Initialize variables
-    session.run(tf.initialize_all_variables())
-    checkpoint = tf.train.get_checkpoint_state(save_dir)
-    if checkpoint and checkpoint.model_checkpoint_path:
-        saver.restore(session, checkpoint.model_checkpoint_path)
+def train(session, graph_ops, feeder, saver):
+    """
+    Train model.
+    """
+    metrics, checkpoints = start_training(session, saver)
 
     # Unpack graph ops
-    q_nn, q_nn_update, s, a, y, loss = graph_ops
+    q_nn, q_nn_update, s, e, actions, values, loss, batch_td, batch_i, target_sync = graph_ops
 
+    epsilon = epsilon_initial
 
-    # Initalize game
     GameState = connect4()
 
-    move_x = bool(random.getrandbits(1))
-    if move_x:
-        print("You're first")
-    else:
-        print("You're second")
+    episode_num = 1
 
-    epsilon = .01
-    terminal = False
-    move_num = 1
-    while not terminal:
-        GameState.printBoard()
-        if(move_x):
-            a_t_index = getValidIndex()
-        else:
-            # Observe the next state
-            s_t = create_state(move_x, GameState.p1_board, GameState.p2_board)
-            # Get Q values for all actions
-            q_t = q_values(session, q_nn, s, s_t)
-            # Choose action based on epsilon-greedy policy
-            q_max_index, a_t_index = choose_action(q_t, GameState.p1_board, GameState.p2_board, epsilon)
+    while episode_num <= episode_max:
+        # Start new game training episode
+        moves, r_t, player = play_episode(session, graph_ops, GameState, epsilon)
+        loss_ep = finish_episode(session, graph_ops, feeder, moves, r_t, player)
+        epsilon = record_episode(metrics, checkpoints, episode_num, r_t, player, GameState.moveNum, loss_ep,
+                                 epsilon)
 
-        r_t, terminal = GameState.apply_action(a_t_index)
+        # Next episode
+        episode_num += 1
 
-        if terminal:
-            if not r_t:
-                print("Draw!")
-            elif move_x:
-                print("You win!")
-            else:
-                print("You lose!")
-        print(Fore.CYAN + "Move:", move_num, Fore.RESET + "\n")
-        move_x = not move_x
-        move_num += 1
+    checkpoints.close()
+    metrics.close()
+
+    test(session, q_nn, s, dump=True)
+
+def play_episode(session, graph_ops, GameState, epsilon):
+    """
+    Play a self-play game from the start with an epsilon-greedy policy. Returns
+    both players' (s_t, a_t, r_t, v_t) moves and the last reward and player.
+    """
+    # Unpack graph ops
+    q_nn, q_nn_update, s, e, actions, values, loss, batch_td, batch_i, target_sync = graph_ops
+
+    GameState.reset()
+    # Moves of both players as (s_t, a_t, r_t, v_t)
+    moves = ([], [])
 
-def getValidIndex():
     while True:
-        action = int(raw_input("Input index from 0-6 to enter move: "))
-        if(action >= 0) and (action <= 6):
-            return action
-        else:
-            print("Invalid action")
+        # Observe the next state
+        s_t = create_state(GameState.p1_turn, GameState.p1_board, GameState.p2_board)
+        # Choose action based on epsilon-greedy policy, with its best legal Q value
+        a_t, v_t = session.run([actions, values], feed_dict={s: [s_t], e: epsilon})
+        a_t_index = int(a_t[0])
+
+        player = 0 if GameState.p1_turn else 1
 
+        # Apply action to state
+        r_t, terminal = GameState.apply_action(a_t_index)
 
-def train(session, graph_ops, summary_ops, saver):
+        # Add update values to batch
+        moves[player].append((s_t, a_t_index, r_t, v_t[0]))
+
+        if terminal: # win or draw
+            return moves, r_t, player
+
+def train_async(session, graph_ops, feeder, saver):
     """
-    Train model.
+    Train model with `threads` asynchronous actor-learner threads sharing the
+    session and variables, each playing its own games and updating the Q
+    network without locks (Hogwild). TensorFlow releases the GIL in
+    session.run, so the threads' evaluations and updates run in parallel.
     """
-    # Initialize variables
-    session.run(tf.initialize_all_variables())
-    checkpoint = tf.train.get_checkpoint_state(save_dir)
-    if checkpoint and checkpoint.model_checkpoint_path:
-        saver.restore(session, checkpoint.model_checkpoint_path)
+    metrics, checkpoints = start_training(session, saver)
+
+    # Episodes played by each thread
+    episode_counts = [0] * threads
+    stop = threading.Event()
+    workers = start_actor_learners(session, graph_ops, feeder, metrics, episode_counts, stop)
+
+    episode_num = 0
+    while episode_num < episode_max and any(worker.is_alive() for worker in workers):
+        time.sleep(.1)
+        episode_num = sum(episode_counts)
+        report_progress(metrics, checkpoints, episode_num)
+
+    stop.set()
+    for worker in workers:
+        worker.join()
+    checkpoints.close()
+    metrics.close()
+
+def start_actor_learners(session, graph_ops, feeder, metrics, episode_counts, stop):
+    """
+    Start an actor-learner thread for every slot of episode_counts, each with
+    its own final exploration rate.
+    """
+    workers = []
+    for index in xrange(len(episode_counts)):
+        thread_epsilon_final = np.random.choice(THREAD_EPSILONS_FINAL, p=THREAD_EPSILONS_PROBS)
+        worker = threading.Thread(target=actor_learner,
+                                  args=(session, graph_ops, feeder, metrics, episode_counts, index,
+                                        thread_epsilon_final, stop))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    return workers
+
+def actor_learner(session, graph_ops, feeder, metrics, episode_counts, index, thread_epsilon_final, stop):
+    """
+    Play self-play games and update Q network with each finished one until
+    stop is set, counting them in episode_counts[index]. Exploration anneals
+    on the episodes of all threads, down to thread_epsilon_final.
+    """
+    # Unpack graph ops
+    q_nn, q_nn_update, s, e, actions, values, loss, batch_td, batch_i, target_sync = graph_ops
 
-    # Initialize summaries writer for tensorflow
-    writer = tf.train.SummaryWriter(summary_dir + "/" + run_name, session.graph)
-    summary_op = tf.merge_all_summaries()
+    GameState = connect4()
 
-    # Unpack graph ops
-    q_nn, q_nn_update, s, a, y, loss = graph_ops
+    while not stop.is_set():
+        progress = min(float(sum(episode_counts)) / epsilon_anneal_episodes, 1.)
+        epsilon = epsilon_initial - (epsilon_initial - thread_epsilon_final) * progress
 
-    # Unpack summary ops
-    win_rate_summary, episode_length_summary, epsilon_summary, loss_summary = summary_ops
+        moves, r_t, player = play_episode(session, graph_ops, GameState, epsilon)
+        loss_ep = finish_episode(session, graph_ops, feeder, moves, r_t, player)
+        if metrics is not None:
+            add_episode_metrics(metrics, r_t, player, GameState.moveNum, loss_ep, epsilon)
+        episode_counts[index] += 1
 
-    # Setup exploration rate parameters
-    epsilon = epsilon_initial
-    epsilon_step = (epsilon_initial - epsilon_final) / epsilon_anneal_episodes
+def train_lockstep(session, graph_ops, feeder, saver):
+    """
+    Train model on lockstep_games self-play games advanced together, with one
+    batched Q network evaluation per ply.
+    """
+    metrics, checkpoints = start_training(session, saver)
 
-    GameState = connect4()
+    # Unpack graph ops
+    q_nn, q_nn_update, s, e, actions, values, loss, batch_td, batch_i, target_sync = graph_ops
 
-    # Accumulated stats
-    stats = []
+    epsilon = epsilon_initial
 
     episode_num = 1
 
-    while episode_num <= episode_max:
-        # Start new game training episode
-        GameState.reset()
-        p1_actions = []
-        p1_states = []
-        p1_rewards = []
-        p1_values = []
+    episodes = lockstep_episodes(session, graph_ops, lockstep_games, lambda: epsilon)
+    for moves, r_t, player, length_ep in episodes:
+        loss_ep = finish_episode(session, graph_ops, feeder, moves, r_t, player)
+        epsilon = record_episode(metrics, checkpoints, episode_num, r_t, player, length_ep, loss_ep, epsilon)
 
-        p2_actions = []
-        p2_states = []
-        p2_rewards = []
-        p2_values = []
+        # Next episode
+        episode_num += 1
+        if episode_num > episode_max:
+            break
 
+    checkpoints.close()
+    metrics.close()
 
-        while True:
-            # Observe the next state
-            s_t = create_state(GameState.p1_turn, GameState.p1_board, GameState.p2_board)
-            # Get Q values for all actions
-            q_t = q_values(session, q_nn, s, s_t)
-            # Choose action based on epsilon-greedy policy
-            q_max_index, a_t_index = choose_action(q_t, GameState.p1_board, GameState.p2_board, epsilon)
+def lockstep_episodes(session, graph_ops, num_games, get_epsilon):
+    """
+    Play num_games self-play games in lockstep, with one batched Q network
+    evaluation per ply, and yield every finished game as
+    (moves, r_t, player, length): both players' (s_t, a_t, r_t, v_t) moves,
+    the last reward and player, and the game's moveNum.
+    """
+    # Unpack graph ops
+    q_nn, q_nn_update, s, e, actions, values, loss, batch_td, batch_i, target_sync = graph_ops
 
+    # Finished games restart right away so every ply evaluates a full batch
+    games = VecConnect4(num_games)
+    moves = [([], []) for _ in xrange(num_games)]
 
+    s_t = games.observe()
+    while True:
+        # Choose actions of all games based on epsilon-greedy policy, with best legal Q values
+        a_t_indices, v_t = session.run([actions, values], feed_dict={s: s_t, e: get_epsilon()})
 
-            # Apply action to state
-            r_t, terminal = GameState.apply_action(a_t_index)
+        players = np.where(games.p1_turn, 0, 1)
+        lengths = games.moveNum + 1
 
-            p1_turn = GameState.p1_turn
+        # Apply actions to states
+        s_next, r_t, terminal = games.step(a_t_indices)
 
-            if p1_turn:
-                # Add update values to batch
-                p1_actions.append(a_t_index)
-                p1_states.append(s_t)
-                p1_rewards.append(r_t)
-                p1_values.append(q_t[q_max_index])
-            else:
-                p2_actions.append(a_t_index)
-                p2_states.append(s_t)
-                p2_rewards.append(r_t)
-                p2_values.append(q_t[q_max_index])
+        for i in xrange(num_games):
+            moves[i][players[i]].append((s_t[i], a_t_indices[i], r_t[i], v_t[i]))
 
+        for i in np.flatnonzero(terminal):
+            yield moves[i], r_t[i], players[i], lengths[i]
+            moves[i] = ([], [])
 
-            if terminal: # win or draw
-                # apply opposite reward to loser
-                if p1_turn:
-                    p2_rewards[-1] = -1
-                    r_t = 1
-                else:
-                    p1_rewards[-1] = -1
-                    r_t = 0
-
-                batch_a = []
-                batch_s = []
-                batch_r = []
-
-                a_t = np.zeros_like(q_t, dtype=np.float32)
-                a_t[p1_actions.pop()] = 1.
-
-                batch_a.append(a_t)
-                batch_s.append(p1_states.pop())
-                batch_r.append(p1_rewards.pop())
-
-                p1_actions.reverse()
-                p1_states.reverse()
-                p1_rewards.reverse()
-                p1_values.reverse()
-                p1_values.pop()
-
-                R = 0.0
-
-                for (ai, si, ri, vi) in zip(p1_actions, p1_states, p1_rewards, p1_values):
-                    a_t = np.zeros_like(q_t, dtype=np.float32)
-                    a_t[ai] = 1.
-                    R = ri + gamma * vi
-                    batch_a.append(a_t)
-                    batch_s.append(si)
-                    batch_r.append(R)
-
-                batch_a = np.stack(batch_a, axis=0)
-                batch_s = np.stack(batch_s, axis=0)
-                batch_r = np.stack(batch_r, axis=0)
-                q_update(session, q_nn_update, s, batch_s, a, batch_a, y, batch_r)
-
-                # Get episode loss
-                loss_ep = q_loss(session, loss, s, batch_s, a, batch_a, y, batch_r)
-
-                R = 0.0
-                batch_a = []
-                batch_s = []
-                batch_r = []
-
-                a_t = np.zeros_like(q_t, dtype=np.float32)
-                a_t[p1_actions.pop()] = 1.
-
-                batch_a.append(a_t)
-                batch_s.append(p1_states.pop())
-                batch_r.append(p1_rewards.pop())
-
-                p2_actions.reverse()
-                p2_states.reverse()
-                p2_rewards.reverse()
-                p2_values.reverse()
-                p2_values.pop()
-
-                for (ai, si, ri, vi) in zip(p2_actions, p2_states, p2_rewards, p2_values):
-                    a_t = np.zeros_like(q_t, dtype=np.float32)
-                    a_t[ai] = 1.
-                    R = ri + gamma * vi
-                    batch_a.append(a_t)
-                    batch_s.append(si)
-                    batch_r.append(R)
-
-                batch_a = np.stack(batch_a, axis=0)
-                batch_s = np.stack(batch_s, axis=0)
-                batch_r = np.stack(batch_r, axis=0)
-                q_update(session, q_nn_update, s, batch_s, a, batch_a, y, batch_r)
-
-
-                # Play test game before next episode
-                length_ep = GameState.moveNum
-                stats.append([r_t, length_ep, loss_ep])
+        s_t = s_next
+
+def train_actors():
+    """
+    Train model in this learner process on episodes played by `actors`
+    self-play processes. Episodes come back through shared-memory slots, and
+    weights and exploration rate are broadcast to the actors through shared
+    memory every weights_interval updates.
+    """
+    graph_ops, input_ops = build_graph()
+    saver = tf.train.Saver(model_variables(), max_to_keep=5)
+
+    # Unpack graph ops
+    q_nn, q_nn_update, s, e, actions, values, loss, batch_td, batch_i, target_sync = graph_ops
+
+    # Shared weights, flattened, with a version bumped on every broadcast
+    variables = tf.trainable_variables()
+    weights = multiprocessing.Array('f', sum(int(np.prod(v.get_shape().as_list())) for v in variables))
+    weights_version = multiprocessing.Value('i', 0)
+    shared_epsilon = multiprocessing.Value('d', epsilon_initial)
+    # Finished episodes from the actors, bounded so they can't run far ahead
+    episodes = SharedEpisodes(8 * actors, board_rows * board_cols, (board_rows, board_cols, 2))
+    stop = multiprocessing.Event()
+
+    # Fork actors before the learner opens its session
+    processes = [multiprocessing.Process(target=actor_process,
+                                         args=(episodes, weights, weights_version, shared_epsilon, stop))
+                 for _ in xrange(actors)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    try:
+        with tf.Session() as session:
+            feeder = BatchFeeder(session, input_ops, board_cols, build_replay(), replay_batch_size)
+
+            metrics, checkpoints = start_training(session, saver)
+            epsilon = epsilon_initial
+
+            publish_weights(session, variables, weights, weights_version)
+            updates = 0
+
+            episode_num = 1
+            while episode_num <= episode_max:
+                batches, r_t, player, length_ep = next_episode(episodes, processes)
+                batches = [(batch_s.astype(np.float32), one_hot(batch_a, board_cols), batch_r,
+                            batch_next.astype(np.float32), batch_d)
+                           for batch_s, batch_a, batch_r, batch_next, batch_d in batches]
+                loss_ep = update_batches(session, graph_ops, feeder, batches)
+                epsilon = record_episode(metrics, checkpoints, episode_num, r_t, player, length_ep, loss_ep,
+                                         epsilon)
+
+                updates += len(batches) if feeder.memory is None else replay_updates
+                if updates >= weights_interval:
+                    shared_epsilon.value = epsilon
+                    publish_weights(session, variables, weights, weights_version)
+                    updates = 0
+
+                # Next episode
+                episode_num += 1
+
+            checkpoints.close()
+            metrics.close()
+            feeder.stop()
+    finally:
+        stop.set()
+        # Keep draining so no actor stays blocked waiting for a free slot
+        while any(process.is_alive() for process in processes):
+            try:
+                episodes.get(timeout=.1)
+            except queue.Empty:
+                pass
+        for process in processes:
+            process.join()
+
+def next_episode(episodes, processes):
+    """
+    Get the next episode from the actors, raising if an actor process died
+    instead of waiting for it forever.
+    """
+    while True:
+        try:
+            return episodes.get(timeout=1.)
+        except queue.Empty:
+            for process in processes:
+                if not process.is_alive():
+                    raise RuntimeError("actor process %d exited with code %s" % (process.pid, process.exitcode))
+
+def actor_process(episodes, weights, weights_version, shared_epsilon, stop):
+    """
+    Play self-play games on CPU with the latest broadcast weights and write
+    every finished episode's update batches to the learner's shared slots.
+    """
+    # Forked actors would otherwise all explore with the same random numbers
+    np.random.seed()
+    random.seed()
+
+    config = tf.ConfigProto(device_count={'GPU': 0},
+                            intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
+    with tf.Graph().as_default(), tf.Session(config=config) as session:
+        graph_ops, input_ops = build_graph()
+        variables = tf.trainable_variables()
+        placeholders = [tf.placeholder(tf.float32, v.get_shape()) for v in variables]
+        assign_op = tf.group(*[v.assign(value) for v, value in zip(variables, placeholders)])
+        session.run(tf.initialize_all_variables())
+
+        # Wait for the learner's first weights
+        while weights_version.value == 0 and not stop.is_set():
+            time.sleep(.1)
+        version = [0]
+
+        def sync_weights():
+            if weights_version.value != version[0]:
+                with weights.get_lock():
+                    version[0] = weights_version.value
+                    flat = np.frombuffer(weights.get_obj(), dtype=np.float32).copy()
+                session.run(assign_op, feed_dict=dict(zip(placeholders, split_weights(flat, variables))))
+
+        sync_weights()
+        for moves, r_t, player, length_ep in lockstep_episodes(session, graph_ops, max(lockstep_games, 1),
+                                                                lambda: shared_epsilon.value):
+            if stop.is_set():
                 break
+            sync_weights()
+
+            # Send compact batches: bool states and action indices
+            batches = [(batch_s.astype(np.bool_), np.argmax(batch_a, axis=1).astype(np.int8), batch_r,
+                        batch_next.astype(np.bool_), batch_d)
+                       for batch_s, batch_a, batch_r, batch_next, batch_d in episode_batches(moves, r_t, player)]
+            if not episodes.put(batches, r_t, player, length_ep, stop):
+                break
+
+def publish_weights(session, variables, weights, weights_version):
+    """
+    Copy variables' values to the shared weights array and bump its version.
+    """
+    flat = np.concatenate([value.ravel() for value in session.run(variables)])
+    with weights.get_lock():
+        np.frombuffer(weights.get_obj(), dtype=np.float32)[:] = flat
+        weights_version.value += 1
 
+def split_weights(flat, variables):
+    """
+    Split flattened weights into arrays shaped as variables.
+    """
+    arrays = []
+    offset = 0
+    for v in variables:
+        shape = v.get_shape().as_list()
+        size = int(np.prod(shape))
+        arrays.append(flat[offset:offset + size].reshape(shape))
+        offset += size
+    return arrays
+
+def episode_batches(moves, r_t, player):
+    """
+    Build Q update batches of both players' (s_t, a_t, r_t, v_t) moves of an
+    episode that player ended with reward r_t.
 
-        # Scale down epsilon after episode
-        if epsilon > epsilon_final:
-            epsilon -= epsilon_step
-
-        # Process stats
-        if len(stats) >= episode_stats:
-            mean_win_rate, mean_length, mean_loss = np.mean(stats, axis=0)
-            print("episode: %d," % episode_num, "epsilon: %.5f," % epsilon, \
-                  "mean win rate: %.3f," % mean_win_rate, "mean length: %.3f," % mean_length,
-                  "mean loss: %.3f" % mean_loss)
-            summary_str = session.run(summary_op, feed_dict={win_rate_summary: mean_win_rate, \
-                                                             episode_length_summary: mean_length,
-                                                             epsilon_summary: epsilon,
-                                                             loss_summary: mean_loss})
-            writer.add_summary(summary_str, episode_num)
-            stats = []
-            saver.save(session, save_dir + '/' + 'checkpoint', global_step = episode_num)
+    Batches are (s, a, r, s_next, d): d is the discount of the bootstrap on
+    s_next's values the Q target adds to r at update time. Without a target
+    network, r already bootstraps on the values seen while acting and d is 0.
+    """
+    if r_t == 1:
+        # apply opposite reward to loser
+        s_l, a_l, _r_l, v_l = moves[1 - player][-1]
+        moves[1 - player][-1] = (s_l, a_l, -1, v_l)
+    states, actions, rewards, values = zip(*(moves[0] + moves[1]))
+    players = np.repeat([0, 1], [len(moves[0]), len(moves[1])])
+    starts = np.arange(len(players)) == 0
+    batch_s = np.stack(states, axis=0)
+    # The last moves' targets are their final rewards, earlier ones bootstrap
+    # on the player's max Q value n_step moves later
+    if target_interval > 0:
+        batch_r, next_index, batch_d = nstep_returns(rewards, players, starts, n_step, gamma)
+        batch_next = batch_s[next_index] * (next_index >= 0)[:, None, None, None]
+        batch_a = one_hot(actions, board_cols)
+    else:
+        batch_r, batch_a = nstep_targets(rewards, values, actions, players, starts, n_step, gamma, board_cols)
+        batch_next = np.zeros_like(batch_s)
+        batch_d = np.zeros_like(batch_r)
+    split = len(moves[0])
+    return [(batch_s[:split], batch_a[:split], batch_r[:split], batch_next[:split], batch_d[:split]),
+            (batch_s[split:], batch_a[split:], batch_r[split:], batch_next[split:], batch_d[split:])]
+
+def finish_episode(session, graph_ops, feeder, moves, r_t, player):
+    """
+    Update Q network with both players' moves of an episode that player ended
+    with reward r_t. Returns the loss of the first update.
+    """
+    return update_batches(session, graph_ops, feeder, episode_batches(moves, r_t, player))
 
-        # Next episode
-        episode_num += 1
+def update_batches(session, graph_ops, feeder, batches):
+    """
+    Update Q network with (s, a, r, s_next, d) batches, or add them to the
+    feeder's replay memory and update with minibatches sampled from it.
+    Returns the loss of the first update, NaN if there was none.
 
-    test(session, q_nn, s, dump=True)
+    Without replay memory, updates are on the batches of the episode before,
+    so these ones are staged in the input queue meanwhile.
+    """
+    if feeder.memory is None:
+        for batch in batches:
+            feeder.put(*batch)
+        losses = [train_step(session, graph_ops, feeder) for _ in xrange(feeder.due(len(batches)))]
+        return losses[0] if losses else np.nan
+
+    for batch in batches:
+        feeder.remember(*batch)
+    if not feeder.ready():
+        return np.nan
+    losses = [train_step(session, graph_ops, feeder) for _ in xrange(replay_updates)]
+    return losses[0]
+
+def train_step(session, graph_ops, feeder):
+    """
+    Update Q network with the next batch of the input queue and reprioritize
+    its transitions by their TD errors. Returns its loss.
+    """
+    q_nn, q_nn_update, s, e, actions, values, loss, batch_td, batch_i, target_sync = graph_ops
+
+    if target_sync is not None and feeder.steps % target_interval == 0:
+        # Copy Q network to the target network, first before any update
+        session.run(target_sync)
+
+    # Loss and TD errors come from the same pass as the update, before it applies
+    _, loss_t, td_t, i_t = session.run([q_nn_update, loss, batch_td, batch_i])
+    feeder.trained(i_t, td_t)
+    return loss_t
+
+def build_replay():
+    """
+    Build replay memory of compact (s, a, r, s_next, d) transitions, or None if disabled.
+    """
+    if replay_capacity <= 0:
+        return None
+    fields = {"s": ((board_rows, board_cols, 2), np.bool_),
+              "a": ((), np.int8),
+              "r": ((), np.float32),
+              "s_next": ((board_rows, board_cols, 2), np.bool_),
+              "d": ((), np.float32)}
+    if prioritized_replay:
+        return PrioritizedReplayMemory(replay_capacity, fields, replay_alpha, replay_beta)
+    return ReplayMemory(replay_capacity, fields)
+
+def start_training(session, saver):
+    """
+    Initialize variables, restore the latest checkpoint if any, and start
+    the metrics and checkpoint writers. Returns them.
+    """
+    session.run(tf.initialize_all_variables())
+    checkpoint = tf.train.get_checkpoint_state(save_dir)
+    if checkpoint and checkpoint.model_checkpoint_path:
+        saver.restore(session, checkpoint.model_checkpoint_path)
+
+    # Initialize metrics written to tensorboard
+    metrics = build_metrics(session)
+
+    checkpoints = build_checkpoints(session, saver)
+    return metrics, checkpoints
+
+def record_episode(metrics, checkpoints, episode_num, r_t, player, length_ep, loss_ep, epsilon):
+    """
+    Add stats of an episode, report them and save checkpoints when due.
+    Returns the exploration rate for the next episode.
+    """
+    add_episode_metrics(metrics, r_t, player, length_ep, loss_ep, epsilon)
+    report_progress(metrics, checkpoints, episode_num)
+
+    # Scale down epsilon after episode
+    if epsilon > epsilon_final:
+        epsilon -= (epsilon_initial - epsilon_final) / epsilon_anneal_episodes
+    return epsilon
+
+def report_progress(metrics, checkpoints, episode_num):
+    """
+    Print flushed stats and save checkpoints when due at episode_num.
+    """
+    means = metrics.maybe_flush(episode_num)
+    if means is not None:
+        print_stats(means, episode_num)
+        checkpoints.maybe_save_best(episode_num, means.get("Loss", np.nan))
+
+    checkpoints.maybe_save(episode_num)
+
+def add_episode_metrics(metrics, r_t, player, length_ep, loss_ep, epsilon):
+    """
+    Add stats of an episode that player ended with reward r_t to metrics.
+    """
+    metrics.add("Win Rate", float(r_t == 1 and player == 0))
+    metrics.add("Episode Length", length_ep)
+    metrics.add("Loss", loss_ep)
+    metrics.add("Epsilon", epsilon)
+
+def print_stats(means, episode_num):
+    """
+    Print the means of flushed episode stats, NaN for stats with no values,
+    as when a timed flush comes before any episode ended.
+    """
+    print("episode: %d," % episode_num, "epsilon: %.5f," % means.get("Epsilon", np.nan), \
+          "mean win rate: %.3f," % means.get("Win Rate", np.nan),
+          "mean length: %.3f," % means.get("Episode Length", np.nan),
+          "mean loss: %.3f," % means.get("Loss", np.nan), "episodes/s: %.1f" % means["Episodes/s"])
+
+def build_metrics(session):
+    """
+    Build metrics written to tensorboard in the background.
+    """
+    return Metrics(summary_dir + "/" + run_name, session.graph, episode_stats, stats_secs, stats_reservoir)
+
+def build_checkpoints(session, saver):
+    """
+    Build checkpoint manager saving in the background, keeping the model with the lowest mean loss.
+    """
+    return CheckpointManager(session, saver, model_variables(), save_dir, checkpoint_episodes, checkpoint_secs)
 
 def test(session, q_nn, s, dump=False):
     """
@@ -375,7 +706,7 @@ def test(session, q_nn, s, dump=False):
         s_t = create_state(move_x, sx_t, so_t)
         # Get Q values for all actions
         q_t = q_values(session, q_nn, s, s_t)
-        _q_max_index, a_t_index = choose_action(q_t, sx_t, so_t, -1.)
+        _q_max_index, a_t_index = choose_action(q_t, ~(sx_t[0] | so_t[0]), -1.)
 
         # Apply action to state
         r_t, sx_t, so_t, terminal = apply_action(move_x, sx_t, so_t, a_t_index)
@@ -410,156 +741,174 @@ def test(session, q_nn, s, dump=False):
         move_x = not move_x
         move_num += 1
 
-def apply_transforms(s, a):
-    """
-    Apply state/action equivalent transforms (rotations/flips).
-    """
-    # Get composite state and apply action to it (with reverse sign to distinct from existing marks)
-    sa = np.sum(s, 0) - a
-
-    # Transpose state from [channel, height, width] to [height, width, channel]
-    s = np.transpose(s, [1, 2, 0])
-
-    s_trans = [s]
-    a_trans = [a]
-    sa_trans = [sa]
-
-    # Apply rotations
-    sa_next = sa
-    for i in xrange(1, 4): # rotate to 90, 180, 270 degrees
-        sa_next = np.rot90(sa_next)
-        if same_states(sa_trans, sa_next):
-            # Skip rotated state matching state already contained in list
-            continue
-        s_trans.append(np.rot90(s, i))
-        a_trans.append(np.rot90(a, i))
-        sa_trans.append(sa_next)
-
-    # Apply flips
-    sa_next = np.fliplr(sa)
-    if not same_states(sa_trans, sa_next):
-        s_trans.append(np.fliplr(s))
-        a_trans.append(np.fliplr(a))
-        sa_trans.append(sa_next)
-    sa_next = np.flipud(sa)
-    if not same_states(sa_trans, sa_next):
-        s_trans.append(np.flipud(s))
-        a_trans.append(np.flipud(a))
-        sa_trans.append(sa_next)
-
-    return [np.transpose(s, [2, 0, 1]) for s in s_trans], a_trans
-
-def same_states(s1, s2):
+def q_values(session, q_nn, s, s_t):
     """
-    Check states s1 (or one of in case of array-like) and s2 are the same.
+    Get Q values for actions from network for given state.
     """
-    return np.any(np.isclose(np.mean(np.square(s1-s2), axis=(1, 2)), 0))
+    return q_nn.eval(session=session, feed_dict={s: [s_t]})[0]
 
-def create_state(move_x, sx, so):
+def q_network(s, reuse=None, trainable=True):
     """
-    Create full state from X and O states.
+    Build Q network on [batch, height, width, channel] states s, reusing its
+    variables if reuse. The architecture flag picks the tower.
     """
-    return np.array([sx, so] if move_x else [so, sx], dtype=np.float)
+    if architecture == "conv":
+        net = conv_tower(s, reuse, trainable)
+    elif architecture == "residual":
+        net = residual_tower(s, reuse, trainable)
+    elif architecture == "mlp":
+        net = s
+    else:
+        raise ValueError("unknown architecture %r" % architecture)
 
-def choose_action(q, sx, so, epsilon):
-    """
-    Choose action index for given state.
-    """
-    # Get valid action indices
-    a_invalid = np.where((sx[0]+so[0])==True)
-    a_vindices = np.where((sx[0]+so[0])==False)
-    for _ in a_invalid:
-        q[_] = -1
-    q_max_index = np.argmax(q)
+    # Flatten inputs
+    net = tf.reshape(net, [-1, int(np.prod(net.get_shape().as_list()[1:]))])
 
-    # Choose next action based on epsilon-greedy policy
-    if np.random.random() <= epsilon:
-        # Choose random action from list of valid actions
-        a_index = np.random.choice(a_vindices[0])
-    else:
-        # Choose valid action w/ max Q
-        a_index = q_max_index
+    if architecture == "mlp":
+        # Hidden fully connected layer
+        net = layers.fully_connected(net, 150, activation_fn=nn.relu, reuse=reuse, trainable=trainable,
+                                     scope="fully_connected")
 
-    return q_max_index, a_index
+    # Output layer
+    net = layers.fully_connected(net, board_cols, activation_fn=None, reuse=reuse, trainable=trainable,
+                                 scope="fully_connected_1")
 
+    # Reshape output to board actions
+    return tf.reshape(net, [-1, board_cols])
 
-def q_values(session, q_nn, s, s_t):
+def conv_layer(net, reuse, trainable, scope, activation_fn=nn.relu):
     """
-    Get Q values for actions from network for given state.
+    Add a 3x3 convolution keeping the board size.
     """
-    return q_nn.eval(session=session, feed_dict={s: [s_t]})[0]
+    return layers.convolution2d(net, conv_filters, [3, 3], activation_fn=activation_fn, reuse=reuse,
+                                trainable=trainable, scope=scope)
 
-def q_update(session, q_nn_update, s, s_t, a, a_t, y, y_t):
+def conv_tower(s, reuse, trainable):
     """
-    Update Q network with (s, a, y) values.
+    Build conv_layers stacked 3x3 convolutions on states s.
     """
-    session.run(q_nn_update, feed_dict={s: s_t, a: a_t, y: y_t})
+    net = s
+    for layer in xrange(conv_layers):
+        net = conv_layer(net, reuse, trainable, "conv_%d" % layer)
+    return net
 
-def q_loss(session, loss, s, s_t, a, a_t, y, y_t):
+def residual_tower(s, reuse, trainable):
     """
-    Get loss for (s, a, y) values.
+    Build a 3x3 convolution followed by conv_layers residual blocks of two
+    3x3 convolutions on states s.
     """
-    return loss.eval(session=session, feed_dict={s: s_t, a: a_t, y: y_t})
-
-def build_summaries():
+    net = conv_layer(s, reuse, trainable, "conv_input")
+    for block in xrange(conv_layers):
+        shortcut = net
+        net = conv_layer(net, reuse, trainable, "residual_%d/conv_0" % block)
+        net = conv_layer(net, reuse, trainable, "residual_%d/conv_1" % block, activation_fn=None)
+        net = nn.relu(net + shortcut)
+    return net
+
+def legal_actions(states):
     """
-    Build tensorboard summaries.
+    Get legal action mask of a batch of states, columns with an empty top cell.
     """
-    win_rate_op = tf.Variable(0.)
-    tf.scalar_summary("Win Rate", win_rate_op)
-    episode_length_op = tf.Variable(0.)
-    tf.scalar_summary("Episode Length", episode_length_op)
-    epsilon_op = tf.Variable(0.)
-    tf.scalar_summary("Epsilon", epsilon_op)
-    loss_op = tf.Variable(0.)
-    tf.scalar_summary("Loss", loss_op)
-    return win_rate_op, episode_length_op, epsilon_op, loss_op
+    return tf.equal(tf.reduce_sum(states[:, 0, :, :], reduction_indices=2), 0.)
 
 def build_graph():
     """
-    Build tensorflow Q network graph.
-    """
-    s = tf.placeholder(tf.float32, [None, 2, board_rows, board_cols], name="s")
-
-    # Inputs shape: [batch, channel, height, width] need to be changed into
-    # shape [batch, height, width, channel]
-    net = tf.transpose(s, [0, 2, 3, 1])
-
-    # Flatten inputs
-    net = tf.reshape(net, [-1, int(np.prod(net.get_shape().as_list()[1:]))])
+    Build tensorflow Q network graph, acting on fed states and training on
+    batches dequeued from an input queue.
 
-    # Hidden fully connected layer
-    net = layers.fully_connected(net, 150, activation_fn=nn.relu)
-
-    # Output layer
-    net = layers.fully_connected(net, board_cols, activation_fn=None)
-
-    # Reshape output to board actions
-    q_nn = tf.reshape(net, [-1, board_cols])
-
-    # Define loss and gradient update ops
+    Returns graph ops and the input ops a BatchFeeder fills the queue with.
+    """
+    s = tf.placeholder(tf.float32, [None, board_rows, board_cols, 2], name="s")
+    q_nn = q_network(s)
+
+    # Epsilon-greedy legal actions, exploration rate e is a scalar or one per state
+    e = tf.placeholder(tf.float32, name="e")
+    legal = legal_actions(s)
+    legal_q = tf.select(legal, q_nn, tf.fill(tf.shape(q_nn), -np.inf))
+    values = tf.reduce_max(legal_q, reduction_indices=1)
+    greedy = tf.argmax(legal_q, 1)
+    # Random legal action: the legal one with the largest random key
+    explored = tf.argmax(tf.select(legal, tf.random_uniform(tf.shape(q_nn)), -tf.ones_like(q_nn)), 1)
+    explore = tf.random_uniform(tf.shape(q_nn)[:1]) < e
+    actions = tf.cast(tf.select(explore, explored, greedy), tf.int32)
+
+    # Update batches are staged in a queue, i holds their replay memory indices
     a = tf.placeholder(tf.float32, [None, board_cols], name="a")
-    y = tf.placeholder(tf.float32, [None], name="y")
-    action_q_values = tf.reduce_sum(tf.mul(q_nn, a))
-    loss = tf.reduce_mean(tf.square(y - action_q_values))
+    r = tf.placeholder(tf.float32, [None], name="r")
+    s_next = tf.placeholder(tf.float32, [None, board_rows, board_cols, 2], name="s_next")
+    d = tf.placeholder(tf.float32, [None], name="d")
+    # Per-transition loss weights, importance sampling weights of prioritized replay
+    w = tf.placeholder(tf.float32, [None], name="w")
+    i = tf.placeholder(tf.int32, [None], name="i")
+    queue = tf.FIFOQueue(input_queue_size, [tf.float32] * 6 + [tf.int32])
+    enqueue = queue.enqueue([s, a, r, s_next, d, w, i])
+    close = queue.close(cancel_pending_enqueues=True)
+    batch_s, batch_a, batch_r, batch_next, batch_d, batch_w, batch_i = queue.dequeue()
+    batch_s.set_shape(s.get_shape())
+    batch_a.set_shape(a.get_shape())
+    batch_next.set_shape(s_next.get_shape())
+
+    target_sync = None
+    batch_y = batch_r
+    if target_interval > 0:
+        # Frozen copy of the Q network, synced every target_interval updates
+        with tf.variable_scope("target"):
+            q_target = q_network(batch_next, trainable=False)
+        target_variables = dict((v.name[len("target/"):], v) for v in tf.all_variables()
+                                if v.name.startswith("target/"))
+        target_sync = tf.group(*[target_variables[v.name].assign(v) for v in tf.trainable_variables()])
+
+        # Bootstrap on the best legal action
+        legal = legal_actions(batch_next)
+        q_next = tf.reduce_max(tf.select(legal, q_target, tf.fill(tf.shape(q_target), -1e9)),
+                               reduction_indices=1)
+        batch_y = batch_r + batch_d * tf.stop_gradient(q_next)
+
+    # Define loss and gradient update ops on the same network
+    batch_q = q_network(batch_s, reuse=True)
+    action_q_values = tf.reduce_sum(tf.mul(batch_q, batch_a), reduction_indices=1)
+    batch_td = batch_y - action_q_values
+    loss = tf.reduce_mean(batch_w * tf.square(batch_td))
     optimizer = tf.train.AdamOptimizer(learning_rate)
     q_nn_update = optimizer.minimize(loss, var_list=tf.trainable_variables())
 
-    return q_nn, q_nn_update, s, a, y, loss
+    return (q_nn, q_nn_update, s, e, actions, values, loss, batch_td, batch_i, target_sync), \
+           (enqueue, close, s, a, r, s_next, d, w, i)
+
+def model_variables():
+    """
+    Get variables saved in checkpoints, all but the target network's.
+    """
+    return [v for v in tf.all_variables() if not v.name.startswith("target/")]
 
 def main(_):
+    if self_play and actors > 0:
+        train_actors()
+        return
+    if not self_play:
+        # Play needs no training graph, nor TensorFlow once the weights are exported
+        play_versus_network(save_dir)
+        return
     with tf.Session() as session:
-        graph_ops = build_graph()
-        summary_ops = build_summaries()
-        saver = tf.train.Saver(max_to_keep=5)
-        if self_play:
-            train(session, graph_ops, summary_ops, saver)
-        else:
-            playVersesNetwork(session, graph_ops, saver)
+        graph_ops, input_ops = build_graph()
+        saver = tf.train.Saver(model_variables(), max_to_keep=5)
+        feeder = BatchFeeder(session, input_ops, board_cols, build_replay(), replay_batch_size)
+        try:
+            if threads > 0:
+                train_async(session, graph_ops, feeder, saver)
+            elif lockstep_games > 0:
+                train_lockstep(session, graph_ops, feeder, saver)
+            else:
+                train(session, graph_ops, feeder, saver)
+        finally:
+            feeder.stop()
 
 def parse_flags():
     global run_name, board_size, marks_win, episode_max, learning_rate, gamma, epsilon_initial, \
-        epsilon_final, epsilon_anneal_episodes, hidden_layer_size, summary_dir
+        epsilon_final, epsilon_anneal_episodes, hidden_layer_size, summary_dir, lockstep_games, n_step, \
+        target_interval, threads, checkpoint_episodes, checkpoint_secs, episode_stats, stats_secs, stats_reservoir, \
+        actors, weights_interval, replay_capacity, replay_batch_size, replay_updates, prioritized_replay, \
+        replay_alpha, replay_beta, input_queue_size, architecture, conv_filters, conv_layers
 
     flags = tf.app.flags
     flags.DEFINE_string("name", run_name, "Tensorboard run name")
@@ -567,12 +916,34 @@ def parse_flags():
     #flags.DEFINE_integer("board_size", board_size, "Board size")
     flags.DEFINE_integer("marks_win", marks_win, "Number of contiguous marks to win")
     flags.DEFINE_integer("hidden_layer_size", hidden_layer_size, "Hidden layer size")
+    flags.DEFINE_string("architecture", architecture, "Q network architecture: mlp, conv or residual")
+    flags.DEFINE_integer("conv_filters", conv_filters, "Number of filters per convolution")
+    flags.DEFINE_integer("conv_layers", conv_layers, "Number of convolutions or residual blocks")
     flags.DEFINE_integer("episodes", episode_max, "Number of training episodes to run")
     flags.DEFINE_float("learning_rate", learning_rate, "Learning rate")
     flags.DEFINE_float("gamma", gamma, "Reward discount rate")
+    flags.DEFINE_integer("n_step", n_step, "Number of moves Q targets look ahead before bootstrapping")
+    flags.DEFINE_integer("target_interval", target_interval, "Number of updates between target network syncs, "
+                         "0 to disable the target network")
     flags.DEFINE_float("epsilon_initial", epsilon_initial, "Initial exploration rate")
     flags.DEFINE_float("epsilon_final", epsilon_final, "Final exploration rate")
     flags.DEFINE_integer("epsilon_anneal", epsilon_anneal_episodes, "Number of training episodes to anneal epsilon")
+    flags.DEFINE_integer("lockstep_games", lockstep_games, "Number of self-play games advanced in lockstep")
+    flags.DEFINE_integer("actors", actors, "Number of self-play actor processes")
+    flags.DEFINE_integer("threads", threads, "Number of asynchronous actor-learner threads")
+    flags.DEFINE_integer("weights_interval", weights_interval, "Number of updates between weights broadcasts")
+    flags.DEFINE_integer("replay_capacity", replay_capacity, "Replay memory capacity, 0 to disable")
+    flags.DEFINE_integer("replay_batch_size", replay_batch_size, "Number of transitions per replay minibatch")
+    flags.DEFINE_integer("replay_updates", replay_updates, "Number of replay minibatch updates per episode")
+    flags.DEFINE_boolean("prioritized_replay", prioritized_replay, "Sample replay transitions by TD error")
+    flags.DEFINE_float("replay_alpha", replay_alpha, "Prioritization exponent")
+    flags.DEFINE_float("replay_beta", replay_beta, "Importance sampling exponent")
+    flags.DEFINE_integer("episode_stats", episode_stats, "Number of episodes to accumulate stats")
+    flags.DEFINE_integer("stats_secs", stats_secs, "Number of seconds to accumulate stats")
+    flags.DEFINE_integer("stats_reservoir", stats_reservoir, "Number of values per stat kept for percentiles")
+    flags.DEFINE_integer("checkpoint_episodes", checkpoint_episodes, "Number of episodes between checkpoints")
+    flags.DEFINE_integer("checkpoint_secs", checkpoint_secs, "Number of seconds between checkpoints")
+    flags.DEFINE_integer("input_queue_size", input_queue_size, "Number of update batches staged in the input queue")
     FLAGS = flags.FLAGS
 
     run_name = FLAGS.name
@@ -580,12 +951,33 @@ def parse_flags():
     #board_size = FLAGS.board_size
     marks_win = FLAGS.marks_win
     hidden_layer_size = FLAGS.hidden_layer_size
+    architecture = FLAGS.architecture
+    conv_filters = FLAGS.conv_filters
+    conv_layers = FLAGS.conv_layers
     episode_max = FLAGS.episodes
     learning_rate = FLAGS.learning_rate
     gamma = FLAGS.gamma
+    n_step = FLAGS.n_step
+    target_interval = FLAGS.target_interval
     epsilon_initial = FLAGS.epsilon_initial
     epsilon_final = FLAGS.epsilon_final
     epsilon_anneal_episodes = FLAGS.epsilon_anneal
+    lockstep_games = FLAGS.lockstep_games
+    actors = FLAGS.actors
+    threads = FLAGS.threads
+    weights_interval = FLAGS.weights_interval
+    replay_capacity = FLAGS.replay_capacity
+    replay_batch_size = FLAGS.replay_batch_size
+    replay_updates = FLAGS.replay_updates
+    prioritized_replay = FLAGS.prioritized_replay
+    replay_alpha = FLAGS.replay_alpha
+    replay_beta = FLAGS.replay_beta
+    input_queue_size = FLAGS.input_queue_size
+    episode_stats = FLAGS.episode_stats
+    stats_secs = FLAGS.stats_secs
+    stats_reservoir = FLAGS.stats_reservoir
+    checkpoint_episodes = FLAGS.checkpoint_episodes
+    checkpoint_secs = FLAGS.checkpoint_secs
 
 if __name__ == "__main__":
     colorama.init()
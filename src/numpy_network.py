@@ -0,0 +1,209 @@
+"""
+Q network inference in pure NumPy, without TensorFlow.
+
+The exporter copies the Q network weights of a checkpoint, named as in the
+graph, into a NumPy .npz file next to it. NumpyQNetwork loads that file in
+milliseconds and evaluates the same mlp, conv or residual tower as
+network.q_network, telling which from the weight names. Weights files are
+named after the checkpoint they were exported from.
+
+Usage:
+    python numpy_network.py --check 1000
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+from connect4 import VecConnect4
+
+
+def weights_path(checkpoint_path):
+    """
+    Get NumPy weights file of checkpoint.
+    """
+    return checkpoint_path + ".weights.npz"
+
+
+def export(checkpoint_path, path):
+    """
+    Write the Q network weights of checkpoint_path to path, leaving out the
+    target network and optimizer slots.
+    """
+    import tensorflow as tf
+
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    weights = dict((name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map()
+                   if name.split("/")[-1] in ("weights", "biases") and not name.startswith("target/"))
+    with open(path, "wb") as f:
+        np.savez(f, **weights)
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def choose_action(q, legal, epsilon):
+    """
+    Choose action index for given Q values and legal action mask.
+    """
+    # Best legal action, illegal ones never win whatever their Q value
+    q_max_index = np.argmax(np.where(legal, q, -np.inf))
+
+    # Choose next action based on epsilon-greedy policy
+    if np.random.random() <= epsilon:
+        # Choose random action from list of valid actions
+        a_index = np.random.choice(np.flatnonzero(legal))
+    else:
+        # Choose valid action w/ max Q
+        a_index = q_max_index
+
+    return q_max_index, a_index
+
+
+class NumpyQNetwork(object):
+    """
+    Forward pass of a Q network from its exported weights.
+
+    Takes a batch of [row, col, channel] states, like the s placeholder, and
+    computes in float32 as TensorFlow does.
+    """
+    def __init__(self, path):
+        self.weights = {}
+        with np.load(path) as f:
+            for name in f.files:
+                # Float arrays in float32, integer ones as they are
+                array = f[name]
+                self.weights[name] = array if array.dtype.kind in "iu" else array.astype(np.float32)
+        if "conv_input/weights" in self.weights:
+            self.architecture = "residual"
+            self.conv_layers = self._count("residual_%d/conv_0/weights")
+            self.conv_filters = self.weights["conv_input/weights"].shape[3]
+        elif "conv_0/weights" in self.weights:
+            self.architecture = "conv"
+            self.conv_layers = self._count("conv_%d/weights")
+            self.conv_filters = self.weights["conv_0/weights"].shape[3]
+        else:
+            self.architecture = "mlp"
+            self.conv_layers = 0
+            self.conv_filters = 0
+
+    def _count(self, name):
+        count = 0
+        while name % count in self.weights:
+            count += 1
+        return count
+
+    def _dense(self, x, scope):
+        return np.dot(x, self.weights[scope + "/weights"]) + self.weights[scope + "/biases"]
+
+    def _conv(self, x, scope, activation=True):
+        # 3x3 convolution with SAME padding as the sum of 9 shifted products
+        kernel = self.weights[scope + "/weights"]
+        rows, cols = x.shape[1:3]
+        padded = np.pad(x, [(0, 0), (1, 1), (1, 1), (0, 0)], "constant")
+        net = self.weights[scope + "/biases"] + np.zeros(x.shape[:3] + kernel.shape[3:], dtype=np.float32)
+        for dy in range(3):
+            for dx in range(3):
+                net += np.dot(padded[:, dy:dy + rows, dx:dx + cols], kernel[dy, dx])
+        return relu(net) if activation else net
+
+    def __call__(self, states):
+        """
+        Get Q values of a batch of states.
+        """
+        net = np.asarray(states, dtype=np.float32)
+        if self.architecture == "conv":
+            for layer in range(self.conv_layers):
+                net = self._conv(net, "conv_%d" % layer)
+        elif self.architecture == "residual":
+            net = self._conv(net, "conv_input")
+            for block in range(self.conv_layers):
+                shortcut = net
+                net = self._conv(net, "residual_%d/conv_0" % block)
+                net = relu(self._conv(net, "residual_%d/conv_1" % block, activation=False) + shortcut)
+
+        # Flatten inputs
+        net = net.reshape(len(net), -1)
+
+        if self.architecture == "mlp":
+            net = relu(self._dense(net, "fully_connected"))
+        return self._dense(net, "fully_connected_1")
+
+
+def self_play_states(num_states, seed=0, net=None, epsilon=1.):
+    """
+    Get states of self-play games, played by net with an epsilon-greedy
+    policy if given, else at random.
+    """
+    rng = np.random.RandomState(seed)
+    games = VecConnect4(64)
+    states = []
+    while len(states) * 64 < num_states:
+        s_t = games.observe()
+        states.append(s_t)
+        actions = np.argmax(np.where(games.legal, rng.random_sample(games.legal.shape), -1.), axis=1)
+        if net is not None:
+            greedy = np.argmax(np.where(games.legal, net(s_t), -np.inf), axis=1)
+            actions = np.where(rng.random_sample(len(s_t)) < epsilon, actions, greedy)
+        games.step(actions)
+    return np.concatenate(states)[:num_states]
+
+
+def check(net, checkpoint_path, states):
+    """
+    Get the largest difference between net's and the TensorFlow network's
+    Q values of states.
+    """
+    import tensorflow as tf
+    import network
+
+    network.architecture = net.architecture
+    network.conv_layers = net.conv_layers
+    network.conv_filters = net.conv_filters
+    with tf.Graph().as_default(), tf.Session() as session:
+        s = tf.placeholder(tf.float32, [None, network.board_rows, network.board_cols, 2])
+        q_nn = network.q_network(s)
+        tf.train.Saver(tf.trainable_variables()).restore(session, checkpoint_path)
+        q_tf = session.run(q_nn, feed_dict={s: states})
+    return float(np.max(np.abs(net(states) - q_tf)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the network weights for NumPy inference.")
+    parser.add_argument("--save_dir", default="checkpoints", help="Checkpoint directory")
+    parser.add_argument("--check", type=int, default=0,
+                        help="Number of self-play states to compare with TensorFlow on, 0 to skip")
+    args = parser.parse_args()
+
+    import tensorflow as tf
+
+    checkpoint = tf.train.get_checkpoint_state(args.save_dir)
+    if not (checkpoint and checkpoint.model_checkpoint_path):
+        raise SystemExit("no checkpoint in %s" % args.save_dir)
+
+    path = weights_path(checkpoint.model_checkpoint_path)
+    export(checkpoint.model_checkpoint_path, path)
+
+    start = time.time()
+    net = NumpyQNetwork(path)
+    load_secs = time.time() - start
+    print("%s network, %.1f KB written to %s, loaded in %.2f ms" %
+          (net.architecture, os.path.getsize(path) / 1e3, path, load_secs * 1e3))
+
+    state = self_play_states(1)
+    start = time.time()
+    for _ in range(1000):
+        net(state)
+    print("%.1f us per move" % ((time.time() - start) * 1e3))
+
+    if args.check:
+        print("max |Q difference| over %d states: %g" %
+              (args.check, check(net, checkpoint.model_checkpoint_path, self_play_states(args.check))))
+
+if __name__ == "__main__":
+    main()
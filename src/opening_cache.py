@@ -0,0 +1,141 @@
+"""
+Precomputed network Q values for every opening position up to a given ply.
+
+The cache is a NumPy file of (key, q) records sorted by key, where key is the
+canonical (mirror-reduced) Zobrist hash of a position and q the network's Q
+values for the canonical orientation. It is memory-mapped when loaded, so
+lookups are a binary search with no TensorFlow involved. Each cache is named
+after the checkpoint it was built from and is ignored once a newer
+checkpoint is saved. It is built with the NumPy network exported from the
+checkpoint, whatever its architecture.
+
+Usage:
+    python opening_cache.py --depth 8
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+from connect4 import connect4, COLS, bits_to_plane
+
+RECORD_DTYPE = np.dtype([("key", np.uint64), ("q", np.float32, (COLS,))])
+
+
+def cache_path(checkpoint_path):
+    """
+    Get opening cache file of checkpoint.
+    """
+    return checkpoint_path + ".openings.npy"
+
+
+def enumerate_positions(depth):
+    """
+    Get canonical hashes, mirror flags and states of the positions reachable
+    in at most depth plies where the game goes on, mirror images dropped.
+    """
+    game = connect4()
+    seen = set()
+    keys = []
+    mirrored = []
+    states = []
+
+    def visit():
+        key, flip = game.canonical_hash()
+        if key in seen:
+            return
+        seen.add(key)
+        keys.append(key)
+        mirrored.append(flip)
+        if game.p1_turn:
+            states.append(np.stack([bits_to_plane(game.p1_bits), bits_to_plane(game.p2_bits)], axis=-1))
+        else:
+            states.append(np.stack([bits_to_plane(game.p2_bits), bits_to_plane(game.p1_bits)], axis=-1))
+        if game.moveNum > depth:
+            return
+        for col in range(COLS):
+            if game.legal[col]:
+                game.push(col)
+                if not game.terminal:
+                    visit()
+                game.pop()
+
+    visit()
+    return (np.array(keys, dtype=np.uint64), np.array(mirrored, dtype=np.bool_),
+            np.array(states, dtype=np.float32))
+
+
+def build(q_fn, depth, batch_size=4096):
+    """
+    Evaluate opening positions up to depth plies with q_fn (a batch of states
+    to a batch of Q values) and get their sorted cache records.
+    """
+    keys, mirrored, states = enumerate_positions(depth)
+    records = np.empty(len(keys), dtype=RECORD_DTYPE)
+    records["key"] = keys
+    for start in range(0, len(keys), batch_size):
+        records["q"][start:start + batch_size] = q_fn(states[start:start + batch_size])
+    # Store Q values of the canonical orientation
+    records["q"][mirrored] = records["q"][mirrored][:, ::-1]
+    records.sort(order="key")
+    return records
+
+
+class OpeningCache(object):
+    """
+    Memory-mapped opening cache lookups.
+
+    Mirror images share one entry, assuming Q values mirror with the board.
+    """
+    def __init__(self, path):
+        self.records = np.load(path, mmap_mode="r")
+        # Keys are searched in a contiguous copy, 8 bytes per position
+        self.keys = np.array(self.records["key"])
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, game):
+        """
+        Get Q values for the actions of game, or None if not cached.
+        """
+        key, mirrored = game.canonical_hash()
+        key = np.uint64(key)
+        index = self.keys.searchsorted(key)
+        if index == len(self.keys) or self.keys[index] != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        q = np.array(self.records[index]["q"])
+        return q[::-1] if mirrored else q
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the network opening cache.")
+    parser.add_argument("--depth", type=int, default=8, help="Deepest ply to cache")
+    parser.add_argument("--batch_size", type=int, default=4096, help="Positions per network evaluation")
+    parser.add_argument("--save_dir", default="checkpoints", help="Checkpoint directory")
+    args = parser.parse_args()
+
+    # Imported here, play imports this module
+    from play import latest_checkpoint, load_network
+
+    checkpoint_path = latest_checkpoint(args.save_dir)
+    if checkpoint_path is None:
+        raise SystemExit("no checkpoint in %s" % args.save_dir)
+    # The NumPy network reads its architecture from the exported weights
+    net = load_network(checkpoint_path)
+
+    start = time.time()
+    records = build(net, args.depth, args.batch_size)
+
+    path = cache_path(checkpoint_path)
+    np.save(path, records)
+    print("%d positions up to ply %d in %.1fs, %.1f MB written to %s" %
+          (len(records), args.depth, time.time() - start, os.path.getsize(path) / 1e6, path))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Play against the network of the latest checkpoint, without TensorFlow.
+
+Moves come from the NumPy Q network exported from the checkpoint, so
+starting a game is loading a small .npz file. Only when the checkpoint has
+no weights file yet is TensorFlow imported, to read the Q network weights
+out of it, without building a graph. Opening moves are looked up in the
+opening cache of the checkpoint if there is one. The time from start to the
+network's first move, leaving out the player's moves, is reported.
+
+Usage:
+    python play.py --save_dir checkpoints
+"""
+
+from __future__ import print_function
+
+import time
+# Start of the time to first move
+start_time = time.time()
+
+import os
+import re
+import random
+import argparse
+
+from connect4 import connect4, create_state
+from numpy_network import NumpyQNetwork, choose_action, export, weights_path
+from opening_cache import OpeningCache, cache_path
+from symmetry import SymmetryCache
+
+# Python 3 compatiblilty hack
+try:
+    input = raw_input
+except NameError:
+    pass
+
+
+def latest_checkpoint(save_dir):
+    """
+    Get path of the latest checkpoint in save_dir, or None, from its
+    checkpoint state file.
+    """
+    try:
+        with open(os.path.join(save_dir, "checkpoint")) as f:
+            match = re.search(r'^model_checkpoint_path: "(.*)"$', f.read(), re.MULTILINE)
+    except IOError:
+        return None
+    if match is None:
+        return None
+    return os.path.join(save_dir, match.group(1))
+
+
+def load_network(checkpoint_path):
+    """
+    Load the NumPy Q network of checkpoint, exporting its weights first if
+    needed.
+    """
+    path = weights_path(checkpoint_path)
+    if not os.path.exists(path):
+        export(checkpoint_path, path)
+    return NumpyQNetwork(path)
+
+
+def cached_q_values(net, s_t, cache, game):
+    """
+    Get Q values for given state from cache if game position is there, else from network.
+    """
+    q_t = cache.lookup(game)
+    if q_t is None:
+        q_t = net([s_t])[0]
+        cache.store(game, q_t)
+    return q_t
+
+
+def get_valid_index():
+    while True:
+        action = int(input("Input index from 0-6 to enter move: "))
+        if(action >= 0) and (action <= 6):
+            return action
+        else:
+            print("Invalid action")
+
+
+def play_versus_network(save_dir, epsilon=.01):
+    """
+    Play a game against the network of the latest checkpoint in save_dir.
+    """
+    from colorama import Fore
+
+    checkpoint_path = latest_checkpoint(save_dir)
+    if checkpoint_path is None:
+        raise SystemExit("no checkpoint in %s" % save_dir)
+    net = load_network(checkpoint_path)
+
+    # Opening moves are looked up in the precomputed cache of the checkpoint
+    openings = None
+    if os.path.exists(cache_path(checkpoint_path)):
+        openings = OpeningCache(cache_path(checkpoint_path))
+
+    # Network moves seen before, or mirrored, are answered from the cache
+    q_cache = SymmetryCache(16)
+
+    # Time to first move leaves out the time the player takes to move
+    ready_secs = time.time() - start_time
+
+    # Initalize game
+    GameState = connect4()
+
+    move_x = bool(random.getrandbits(1))
+    if move_x:
+        print("You're first")
+    else:
+        print("You're second")
+
+    first_move = True
+    terminal = False
+    move_num = 1
+    while not terminal:
+        GameState.printBoard()
+        if(move_x):
+            a_t_index = get_valid_index()
+        else:
+            move_start = time.time()
+            q_t = None if openings is None else openings.lookup(GameState)
+            if q_t is None:
+                # Observe the next state
+                s_t = create_state(GameState.p1_turn, GameState.p1_board, GameState.p2_board)
+                # Get Q values for all actions
+                q_t = cached_q_values(net, s_t, q_cache, GameState)
+            # Choose action based on epsilon-greedy policy
+            q_max_index, a_t_index = choose_action(q_t, GameState.legal, epsilon)
+            if first_move:
+                first_move = False
+                print("Time to first move: %.3fs" % (ready_secs + time.time() - move_start))
+
+        r_t, terminal = GameState.apply_action(a_t_index)
+
+        if terminal:
+            if not r_t:
+                print("Draw!")
+            elif move_x:
+                print("You win!")
+            else:
+                print("You lose!")
+        print(Fore.CYAN + "Move:", move_num, Fore.RESET + "\n")
+        move_x = not move_x
+        move_num += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play against the network.")
+    parser.add_argument("--save_dir", default="checkpoints", help="Checkpoint directory")
+    args = parser.parse_args()
+
+    import colorama
+    colorama.init()
+
+    play_versus_network(args.save_dir)
+
+if __name__ == "__main__":
+    main()
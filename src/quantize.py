@@ -0,0 +1,174 @@
+"""
+Post-training int8 quantization of the Q network for CPU inference.
+
+Weights of every dense and convolution layer are rounded to int8 with one
+scale per output channel. Each layer's input is rounded to int8 with one
+scale, calibrated as the largest value it takes on positions of the
+network's self-play games. Layers multiply int8 by int8 into int32 sums,
+scaled back to float before adding their float biases, so the weights take
+a quarter of the memory of float32 ones. Quantized weights files are named
+after the checkpoint they were quantized from.
+
+Usage:
+    python quantize.py --calibration 10000 --evaluation 10000
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+
+from numpy_network import NumpyQNetwork, self_play_states, weights_path
+from play import latest_checkpoint, load_network
+
+
+def quantized_path(checkpoint_path):
+    """
+    Get int8 weights file of checkpoint.
+    """
+    return checkpoint_path + ".int8.npz"
+
+
+def quantize_channels(weights):
+    """
+    Round weights to int8 with a symmetric scale per output channel, the
+    last axis. Returns the int8 weights and the scales.
+    """
+    axes = tuple(range(weights.ndim - 1))
+    scales = np.max(np.abs(weights), axis=axes) / 127.
+    scales[scales == 0] = 1.
+    return np.clip(np.round(weights / scales), -127, 127).astype(np.int8), scales.astype(np.float32)
+
+
+def quantize_inputs(x, scale):
+    """
+    Round layer inputs to int8 with scale.
+    """
+    return np.clip(np.round(x / scale), -127, 127).astype(np.int8)
+
+
+class CalibratingQNetwork(NumpyQNetwork):
+    """
+    Float Q network recording the largest absolute input of every layer.
+    """
+    def __init__(self, path):
+        super(CalibratingQNetwork, self).__init__(path)
+        self.ranges = {}
+
+    def _record(self, x, scope):
+        self.ranges[scope] = max(self.ranges.get(scope, 0.), float(np.max(np.abs(x))))
+
+    def _dense(self, x, scope):
+        self._record(x, scope)
+        return super(CalibratingQNetwork, self)._dense(x, scope)
+
+    def _conv(self, x, scope, activation=True):
+        self._record(x, scope)
+        return super(CalibratingQNetwork, self)._conv(x, scope, activation)
+
+
+def quantize(path, states, batch_size=1024):
+    """
+    Quantize the float weights file path, calibrating layer inputs on states.
+    Returns the arrays of the int8 weights file.
+    """
+    net = CalibratingQNetwork(path)
+    for start in range(0, len(states), batch_size):
+        net(states[start:start + batch_size])
+
+    arrays = {}
+    for scope, input_range in net.ranges.items():
+        weights, scales = quantize_channels(net.weights[scope + "/weights"])
+        arrays[scope + "/weights"] = weights
+        arrays[scope + "/scales"] = scales
+        arrays[scope + "/biases"] = net.weights[scope + "/biases"]
+        arrays[scope + "/input_scale"] = np.float32(max(input_range, 1e-8) / 127.)
+    return arrays
+
+
+class QuantizedQNetwork(NumpyQNetwork):
+    """
+    Forward pass of a Q network from its int8 weights file.
+
+    NumPy has no int8 matrix product and its integer ones skip BLAS, so the
+    int8 operands are widened to float64 when multiplied, where their sums
+    are exact: the same int32 sums an int8 kernel would compute.
+    """
+    def _dense(self, x, scope):
+        x = quantize_inputs(x, self.weights[scope + "/input_scale"])
+        sums = np.dot(x.astype(np.float64), self.weights[scope + "/weights"].astype(np.float64))
+        return self._dequantize(sums, scope)
+
+    def _conv(self, x, scope, activation=True):
+        # 3x3 convolution with SAME padding as the sum of 9 shifted products
+        kernel = self.weights[scope + "/weights"].astype(np.float64)
+        rows, cols = x.shape[1:3]
+        padded = np.pad(quantize_inputs(x, self.weights[scope + "/input_scale"]).astype(np.float64),
+                        [(0, 0), (1, 1), (1, 1), (0, 0)], "constant")
+        sums = np.zeros(x.shape[:3] + kernel.shape[3:])
+        for dy in range(3):
+            for dx in range(3):
+                sums += np.dot(padded[:, dy:dy + rows, dx:dx + cols], kernel[dy, dx])
+        net = self._dequantize(sums, scope)
+        return np.maximum(net, 0, out=net) if activation else net
+
+    def _dequantize(self, sums, scope):
+        scales = self.weights[scope + "/input_scale"] * self.weights[scope + "/scales"]
+        return (sums * scales + self.weights[scope + "/biases"]).astype(np.float32)
+
+
+def greedy_actions(q, states):
+    """
+    Get best legal actions of a batch of Q values of states.
+    """
+    legal = np.sum(states[:, 0, :, :], axis=2) == 0
+    return np.argmax(np.where(legal, q, -np.inf), axis=1)
+
+
+def time_move(net, state, repeat=1000):
+    """
+    Time net on one state, in seconds.
+    """
+    start = time.time()
+    for _ in range(repeat):
+        net(state)
+    return (time.time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the network to int8.")
+    parser.add_argument("--save_dir", default="checkpoints", help="Checkpoint directory")
+    parser.add_argument("--calibration", type=int, default=10000, help="Number of self-play states to calibrate on")
+    parser.add_argument("--evaluation", type=int, default=10000, help="Number of self-play states to compare on")
+    parser.add_argument("--epsilon", type=float, default=.1, help="Exploration rate of the self-play games")
+    args = parser.parse_args()
+
+    checkpoint_path = latest_checkpoint(args.save_dir)
+    if checkpoint_path is None:
+        raise SystemExit("no checkpoint in %s" % args.save_dir)
+    net = load_network(checkpoint_path)
+
+    # Calibrate and evaluate on positions of different games
+    calibration = self_play_states(args.calibration, 0, net, args.epsilon)
+    evaluation = self_play_states(args.evaluation, 1, net, args.epsilon)
+
+    path = quantized_path(checkpoint_path)
+    with open(path, "wb") as f:
+        np.savez(f, **quantize(weights_path(checkpoint_path), calibration))
+    quantized = QuantizedQNetwork(path)
+
+    q_float = net(evaluation)
+    q_int8 = quantized(evaluation)
+    agreement = np.mean(greedy_actions(q_float, evaluation) == greedy_actions(q_int8, evaluation))
+    float_bytes = sum(a.nbytes for name, a in net.weights.items() if name.endswith("/weights"))
+    int8_bytes = sum(a.nbytes for name, a in quantized.weights.items() if name.endswith("/weights"))
+    print("%s written, weights %.1f KB -> %.1f KB" % (path, float_bytes / 1e3, int8_bytes / 1e3))
+    print("greedy action agreement over %d states: %.4f, max |Q difference|: %g" %
+          (len(evaluation), agreement, float(np.max(np.abs(q_float - q_int8)))))
+    print("%.1f us per move float, %.1f us per move int8" %
+          (time_move(net, evaluation[:1]) * 1e6, time_move(quantized, evaluation[:1]) * 1e6))
+
+if __name__ == "__main__":
+    main()
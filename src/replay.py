@@ -0,0 +1,152 @@
+import numpy as np
+
+
+class ReplayMemory(object):
+    """
+    Fixed-capacity ring buffer of transitions in preallocated arrays.
+
+    Fields are given as {name: (shape, dtype)}; once full, new transitions
+    overwrite the oldest ones.
+    """
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.arrays = dict((name, np.zeros((capacity,) + tuple(shape), dtype=dtype))
+                           for name, (shape, dtype) in fields.items())
+        # Number of stored transitions and index of the next one to write
+        self.size = 0
+        self.next_index = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, **values):
+        """
+        Store one transition, returns its index.
+        """
+        index = self.next_index
+        for name, value in values.items():
+            self.arrays[name][index] = value
+        self.next_index = (index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return index
+
+    def add_batch(self, **values):
+        """
+        Store a batch of transitions, returns their indices.
+        """
+        count = len(next(iter(values.values())))
+        indices = (self.next_index + np.arange(count)) % self.capacity
+        for name, value in values.items():
+            self.arrays[name][indices] = value
+        self.next_index = (self.next_index + count) % self.capacity
+        self.size = min(self.size + count, self.capacity)
+        return indices
+
+    def get(self, indices):
+        """
+        Get fields of transitions at indices.
+        """
+        return dict((name, array[indices]) for name, array in self.arrays.items())
+
+    def sample(self, batch_size):
+        """
+        Sample transitions uniformly, returns their indices and fields.
+        """
+        indices = np.random.randint(0, self.size, size=batch_size)
+        return indices, self.get(indices)
+
+
+class SumTree(object):
+    """
+    Binary tree in one array whose nodes hold the sum of their children's
+    priorities; the root is at 1 and the leaves start at `leaves`.
+    """
+    def __init__(self, capacity):
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        self.depth = self.leaves.bit_length() - 1
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        """
+        Get priorities of leaves at indices.
+        """
+        return self.tree[self.leaves + indices]
+
+    def update(self, indices, priorities):
+        """
+        Set priorities of leaves at indices and fix their ancestors' sums.
+        """
+        nodes = self.leaves + np.asarray(indices)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """
+        Get the leaf indices where the running sum of priorities passes values.
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = values > self.tree[left]
+            values -= np.where(right, self.tree[left], 0.)
+            nodes = left + right
+        return nodes - self.leaves
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    Replay memory sampling transitions in proportion to priority ** alpha,
+    with importance sampling weights (size * P) ** -beta (Schaul et al.,
+    2015). beta is fixed, not annealed towards 1 over training.
+
+    New transitions get the highest priority seen so far so they are sampled
+    at least once.
+    """
+    def __init__(self, capacity, fields, alpha=.6, beta=.4, epsilon=1e-3):
+        super(PrioritizedReplayMemory, self).__init__(capacity, fields)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.
+
+    def add(self, **values):
+        index = super(PrioritizedReplayMemory, self).add(**values)
+        self.tree.update([index], [self.max_priority])
+        return index
+
+    def add_batch(self, **values):
+        indices = super(PrioritizedReplayMemory, self).add_batch(**values)
+        self.tree.update(indices, np.full(len(indices), self.max_priority))
+        return indices
+
+    def sample(self, batch_size):
+        """
+        Sample transitions by priority, returns their indices, fields and
+        normalized importance sampling weights.
+        """
+        # One sample from each of batch_size equal slices of the total priority
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * segment
+        indices = np.minimum(self.tree.find(values), self.size - 1)
+
+        probabilities = self.tree.get(indices) / self.tree.total()
+        weights = (self.size * probabilities) ** -self.beta
+        weights /= weights.max()
+        return indices, self.get(indices), weights.astype(np.float32)
+
+    def update_priorities(self, indices, errors):
+        """
+        Set priorities of transitions at indices from their TD errors.
+        """
+        priorities = (np.abs(errors) + self.epsilon) ** self.alpha
+        self.tree.update(indices, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
@@ -0,0 +1,79 @@
+import numpy as np
+
+
+def nstep_returns(rewards, players, starts, n=1, gamma=.8):
+    """
+    Compute n-step discounted returns of a batch of episodes, without their
+    bootstrap.
+
+    Transitions are given in play order, episodes one after another:
+    rewards and players (the mover) are per transition, starts marks the
+    first transition of every episode. Each player's return sums its own
+    rewards over its next n moves,
+        r_k + gamma r_k+1 + ... + gamma^(n-1) r_k+n-1,
+    to be bootstrapped with gamma^n times its value n moves later. Returns
+    the returns, the index of that later transition (-1 past the end of the
+    episode) and its discount (0 past the end of the episode).
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    players = np.asarray(players)
+    episodes = np.cumsum(starts) - 1
+
+    # Lay out every (episode, player) sequence contiguously
+    groups = episodes * (players.max() + 1) + players
+    order = np.argsort(groups, kind="mergesort")
+    rewards = rewards[order]
+    groups = groups[order]
+
+    size = len(rewards)
+    index = np.arange(size)
+    group_starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    group_ends = np.r_[group_starts[1:], size]
+    lengths = group_ends - group_starts
+    # Position of each transition in its sequence and index past its sequence
+    position = index - np.repeat(group_starts, lengths)
+    end = np.repeat(group_ends, lengths)
+    horizon = np.minimum(index + n, end)
+    bootstrap = horizon < end
+
+    if gamma == 0:
+        returns = rewards
+    else:
+        # Reverse cumulative sum of rewards discounted from their sequence
+        # start, so a difference of two sums is a discounted window. A player
+        # makes at most 21 moves, far from gamma ** position underflowing.
+        discounts = gamma ** position
+        cumulative = np.r_[np.cumsum((rewards * discounts)[::-1])[::-1], 0.]
+        returns = (cumulative[index] - cumulative[horizon]) / discounts
+
+    unsorted_returns = np.empty(size, dtype=np.float32)
+    unsorted_returns[order] = returns
+    next_index = np.full(size, -1, dtype=np.int64)
+    next_index[order[bootstrap]] = order[horizon[bootstrap]]
+    next_discount = np.zeros(size, dtype=np.float32)
+    next_discount[order[bootstrap]] = gamma ** n
+    return unsorted_returns, next_index, next_discount
+
+
+def nstep_targets(rewards, values, actions, players, starts, n=1, gamma=.8, num_actions=7):
+    """
+    Compute n-step Q targets and one-hot actions of a batch of episodes.
+
+    As nstep_returns, with values (the mover's max Q value at each state) to
+    bootstrap on, so each player's target is
+        y_k = r_k + gamma r_k+1 + ... + gamma^(n-1) r_k+n-1 + gamma^n v_k+n,
+    without the last term once that passes the end of the episode.
+    """
+    returns, next_index, next_discount = nstep_returns(rewards, players, starts, n, gamma)
+    values = np.asarray(values, dtype=np.float32)
+    targets = returns + next_discount * np.where(next_index >= 0, values[next_index], 0.)
+    return targets.astype(np.float32), one_hot(actions, num_actions)
+
+
+def one_hot(actions, num_actions=7):
+    """
+    Get one-hot matrix of action indices.
+    """
+    matrix = np.zeros([len(actions), num_actions], dtype=np.float32)
+    matrix[np.arange(len(actions)), actions] = 1.
+    return matrix
@@ -0,0 +1,82 @@
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+
+class SharedEpisodes(object):
+    """
+    Finished episodes passed from actor processes to the learner through
+    shared memory.
+
+    Transitions are written into preallocated slots of shared arrays, one
+    episode per slot, and only slot indices and a few scalars go through the
+    queues, so states are never pickled. The learner hands a slot back once
+    it has copied the episode out, so at most num_slots episodes are in
+    flight. Must be created before the actors are forked.
+    """
+    def __init__(self, num_slots, max_moves, state_shape):
+        state_shape = tuple(state_shape)
+        state_size = int(np.prod(state_shape))
+        self.s = self._array('b', np.bool_, (num_slots, max_moves) + state_shape, state_size)
+        self.s_next = self._array('b', np.bool_, (num_slots, max_moves) + state_shape, state_size)
+        self.a = self._array('b', np.int8, (num_slots, max_moves), 1)
+        self.r = self._array('f', np.float32, (num_slots, max_moves), 1)
+        self.d = self._array('f', np.float32, (num_slots, max_moves), 1)
+        self.free = multiprocessing.Queue()
+        self.full = multiprocessing.Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+
+    @staticmethod
+    def _array(typecode, dtype, shape, item_size):
+        raw = multiprocessing.RawArray(typecode, shape[0] * shape[1] * item_size)
+        return np.frombuffer(raw, dtype=np.dtype(typecode)).view(dtype).reshape(shape)
+
+    def put(self, batches, r_t, player, length, stop):
+        """
+        Write an episode's (s, a, r, s_next, d) batches, bool states and
+        action indices, into a free slot and queue it for the learner. Waits
+        for a free slot until stop is set, returns whether it was queued.
+        """
+        while True:
+            try:
+                slot = self.free.get(timeout=.1)
+                break
+            except queue.Empty:
+                if stop.is_set():
+                    return False
+        sizes = []
+        start = 0
+        for batch_s, batch_a, batch_r, batch_next, batch_d in batches:
+            end = start + len(batch_r)
+            self.s[slot, start:end] = batch_s
+            self.a[slot, start:end] = batch_a
+            self.r[slot, start:end] = batch_r
+            self.s_next[slot, start:end] = batch_next
+            self.d[slot, start:end] = batch_d
+            sizes.append(len(batch_r))
+            start = end
+        self.full.put((slot, sizes, r_t, player, length))
+        return True
+
+    def get(self, timeout=None):
+        """
+        Get the next episode as (batches, r_t, player, length), copied out of
+        its slot. Raises queue.Empty if none is queued within timeout.
+        """
+        slot, sizes, r_t, player, length = self.full.get(timeout=timeout)
+        batches = []
+        start = 0
+        for size in sizes:
+            end = start + size
+            batches.append((self.s[slot, start:end].copy(), self.a[slot, start:end].copy(),
+                            self.r[slot, start:end].copy(), self.s_next[slot, start:end].copy(),
+                            self.d[slot, start:end].copy()))
+            start = end
+        self.free.put(slot)
+        return batches, r_t, player, length
@@ -0,0 +1,281 @@
+"""
+Perfect-play connect4 solver used as an evaluation oracle.
+
+Negamax with alpha-beta pruning on bitboards, a transposition table of upper
+bounds, center-first move ordering refined by the number of threats a move
+creates, and a null-window search driving it. Scores follow the usual
+convention: 0 is a draw, a positive score is a win for the player to move and
+a negative one a loss, the earlier the win the larger the score (22 minus the
+number of stones the winner has played when winning).
+
+On one CPU it solves about 12k positions a minute 22 stones in, 1.3k at 20,
+500 at 18 and 300 at 16. Scoring thousands of positions a minute only holds
+from 20 stones on; earlier openings take seconds or minutes each.
+
+Usage:
+    python solver.py 52133510205263046323 6150102361340410
+    echo 6150102361340410 | python solver.py --weak
+Positions are the columns (0-6) played from the start, one digit per move.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from connect4 import connect4, ROWS, COLS, H1, BOTTOM_MASK, BOARD_MASK
+
+CELLS = ROWS * COLS
+MIN_SCORE = -CELLS // 2 + 3
+MAX_SCORE = (CELLS + 1) // 2 - 3
+
+# Columns to try first, center out
+COLUMN_ORDER = sorted(range(COLS), key=lambda col: abs(COLS // 2 - col))
+COLUMN_MASKS = [((1 << ROWS) - 1) << (col * H1) for col in range(COLS)]
+
+_M64 = (1 << 64) - 1
+
+
+def _table_key(key):
+    """
+    Mix position key so the table's low-bit index depends on every column.
+    """
+    key = (key * 0x9E3779B97F4A7C15) & _M64
+    return key ^ (key >> 32)
+
+
+def _half(score):
+    """
+    Halve score rounding toward zero.
+    """
+    return -(-score // 2) if score < 0 else score // 2
+
+
+def winning_cells(position, mask):
+    """
+    Get empty cells that would complete a line of position's stones.
+    """
+    # Unrolled over the shifts of the four directions, this is the hot spot
+    # vertical
+    r = (position << 1) & (position << 2) & (position << 3)
+    # horizontal, the pair to the right is the pair to the left shifted back
+    p = (position << 7) & (position << 14)
+    r |= p & (position << 21)
+    r |= p & (position >> 7)
+    p >>= 21
+    r |= p & (position << 7)
+    r |= p & (position >> 21)
+    # down-right diagonal
+    p = (position << 6) & (position << 12)
+    r |= p & (position << 18)
+    r |= p & (position >> 6)
+    p >>= 18
+    r |= p & (position << 6)
+    r |= p & (position >> 18)
+    # up-right diagonal
+    p = (position << 8) & (position << 16)
+    r |= p & (position << 24)
+    r |= p & (position >> 8)
+    p >>= 24
+    r |= p & (position << 8)
+    r |= p & (position >> 24)
+    return r & (BOARD_MASK ^ mask)
+
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(bits):
+        return bin(bits).count("1")
+
+
+class Solver(object):
+    """
+    Exact game-theoretic evaluation of connect4 positions.
+
+    The transposition table is kept between calls, so solving positions of
+    the same game one after another gets faster. It is a pair of plain lists
+    rather than a TranspositionTable: the search reads or writes it at every
+    node, and indexing NumPy arrays with Python ints costs more than the
+    rest of the node.
+    """
+    def __init__(self, size_log2=22):
+        # Upper bounds, offset to be positive, of always-replaced slots
+        self.table_mask = (1 << size_log2) - 1
+        self.table_keys = [-1] * (1 << size_log2)
+        self.table_bounds = [0] * (1 << size_log2)
+        # Number of negamax nodes searched so far
+        self.nodes = 0
+
+    def solve(self, game, weak=False):
+        """
+        Get score of game for the player to move, or only its sign if weak.
+        """
+        current, mask, moves = self._position(game)
+        return self._solve(current, mask, moves, weak)
+
+    def analyze(self, game, weak=False):
+        """
+        Get score of every column for the player to move, None for full ones.
+        """
+        current, mask, moves = self._position(game)
+        scores = [None] * COLS
+        for col in range(COLS):
+            if mask & (1 << (col * H1 + ROWS - 1)):
+                continue
+            move = (mask + (1 << (col * H1))) & COLUMN_MASKS[col]
+            if winning_cells(current, mask) & move:
+                scores[col] = 1 if weak else (CELLS + 1 - moves) // 2
+            else:
+                scores[col] = -self._solve(current ^ mask, mask | move, moves + 1, weak)
+        return scores
+
+    def best_move(self, game, weak=False):
+        """
+        Get best column for the player to move and its score, center first on ties.
+        """
+        scores = self.analyze(game, weak)
+        best = max((col for col in COLUMN_ORDER if scores[col] is not None),
+                   key=lambda col: scores[col])
+        return best, scores[best]
+
+    def optimal_moves(self, game, weak=False):
+        """
+        Get mask of columns with the best score for the player to move.
+        """
+        scores = self.analyze(game, weak)
+        best = max(score for score in scores if score is not None)
+        return np.array([score == best for score in scores], dtype=np.bool_)
+
+    def _position(self, game):
+        if game.terminal:
+            raise ValueError("game is over")
+        current = game.p1_bits if game.p1_turn else game.p2_bits
+        return current, game.p1_bits | game.p2_bits, game.moveNum - 1
+
+    def _solve(self, current, mask, moves, weak):
+        if winning_cells(current, mask) & ((mask + BOTTOM_MASK) & BOARD_MASK):
+            return 1 if weak else (CELLS + 1 - moves) // 2
+        if weak:
+            low, high = -1, 1
+        else:
+            low, high = -((CELLS - moves) // 2), (CELLS + 1 - moves) // 2
+        # Null window search, converging on the score from both sides
+        while low < high:
+            med = low + (high - low) // 2
+            if med <= 0 and _half(low) < med:
+                med = _half(low)
+            elif med >= 0 and _half(high) > med:
+                med = _half(high)
+            score = self._negamax(current, mask, moves, med, med + 1, winning_cells(current ^ mask, mask))
+            if score <= med:
+                high = score
+            else:
+                low = score
+        if weak:
+            return (low > 0) - (low < 0)
+        return low
+
+    def _negamax(self, current, mask, moves, alpha, beta, opponent_wins):
+        """
+        Search position where the player to move can't win right away, given
+        the cells that would win it for the opponent.
+        """
+        self.nodes += 1
+
+        # Moves that don't hand the opponent an immediate win
+        possible = (mask + BOTTOM_MASK) & BOARD_MASK
+        forced = possible & opponent_wins
+        if forced:
+            if forced & (forced - 1):
+                # Two threats can't both be blocked
+                return -((CELLS - moves) // 2)
+            possible = forced
+        possible &= ~(opponent_wins >> 1)
+        if not possible:
+            return -((CELLS - moves) // 2)
+        if moves >= CELLS - 2:
+            return 0
+
+        # Lower bound: the opponent can't win before its next move
+        low = -((CELLS - 2 - moves) // 2)
+        if alpha < low:
+            alpha = low
+            if alpha >= beta:
+                return alpha
+        # Upper bound: we can't win right away
+        high = (CELLS - 1 - moves) // 2
+        key = current + mask
+        index = _table_key(key) & self.table_mask
+        if self.table_keys[index] == key:
+            high = self.table_bounds[index] + MIN_SCORE - 1
+        if beta > high:
+            beta = high
+            if alpha >= beta:
+                return beta
+
+        # Order moves by the number of threats they create, center first on
+        # ties. The threats are the opponent's winning cells in the child.
+        children = []
+        for col in COLUMN_ORDER:
+            move = possible & COLUMN_MASKS[col]
+            if move:
+                wins = winning_cells(current | move, mask) & ~move
+                children.append((_popcount(wins), -len(children), move, wins))
+        if len(children) > 1:
+            children.sort(reverse=True)
+
+        for _threats, _order, move, wins in children:
+            score = -self._negamax(current ^ mask, mask | move, moves + 1, -beta, -alpha, wins)
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+
+        self.table_keys[index] = key
+        self.table_bounds[index] = alpha - MIN_SCORE + 1
+        return alpha
+
+
+def game_from_moves(moves):
+    """
+    Build a connect4 game from a string of columns (0-6).
+    """
+    game = connect4()
+    for move in moves:
+        if not move.isdigit() or not 0 <= int(move) < COLS:
+            raise ValueError("invalid move sequence: %s" % moves)
+        move = int(move)
+        if not game.legal[move] or game.terminal:
+            raise ValueError("invalid move sequence: %s" % moves)
+        game.apply_action(move)
+    return game
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solve connect4 positions.")
+    parser.add_argument("positions", nargs="*",
+                        help="Columns (0-6) played from the start, read from stdin if none")
+    parser.add_argument("--weak", action="store_true", help="Only solve win/draw/loss")
+    parser.add_argument("--table_size", type=int, default=22, help="log2 of transposition table size")
+    args = parser.parse_args()
+
+    solver = Solver(args.table_size)
+    # Blank lines of stdin are skipped rather than solving the empty board
+    positions = args.positions or (line.strip() for line in sys.stdin if line.strip())
+    for moves in positions:
+        try:
+            game = game_from_moves(moves)
+        except ValueError as error:
+            parser.error(str(error))
+        nodes = solver.nodes
+        start = time.time()
+        best, score = solver.best_move(game, args.weak)
+        print("%s score: %d best: %d nodes: %d time: %.3fs" %
+              (moves or "-", score, best, solver.nodes - nodes, time.time() - start))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+from connect4 import COLS
+from transposition import TranspositionTable
+
+
+class SymmetryCache(object):
+    """
+    Cache of per-action values shared between mirrored positions.
+
+    Values are stored for the canonical form of a connect4 position and
+    flipped back on the way out when looked up from its mirror image.
+    """
+    def __init__(self, size_log2=20):
+        self.table = TranspositionTable(size_log2, [COLS])
+        # Hits on positions whose canonical form is their mirror image
+        self.mirrored_hits = 0
+
+    def lookup(self, game):
+        """
+        Get values for the actions of game, or None.
+        """
+        key, mirrored = game.canonical_hash()
+        values = self.table.lookup(key)
+        if values is None or not mirrored:
+            return values
+        self.mirrored_hits += 1
+        return values[::-1]
+
+    def store(self, game, values):
+        """
+        Store values for the actions of game.
+        """
+        key, mirrored = game.canonical_hash()
+        if mirrored:
+            values = values[::-1]
+        return self.table.store(key, values)
+
+    def stats(self):
+        """
+        Get hit, miss and mirrored hit counts and hit rate.
+        """
+        return {"hits": self.table.hits,
+                "misses": self.table.misses,
+                "mirrored_hits": self.mirrored_hits,
+                "hit_rate": self.table.hit_rate()}
@@ -0,0 +1,69 @@
+import numpy as np
+
+
+class TranspositionTable(object):
+    """
+    Fixed-size table of position values keyed by 64-bit position hashes.
+
+    Entries live in preallocated arrays indexed by the low bits of the hash.
+    When two positions share a slot the entry searched to the greater depth
+    is kept; on equal depth the newer entry replaces the older one.
+    """
+    def __init__(self, size_log2=20, value_shape=(), dtype=np.float32):
+        size = 1 << size_log2
+        self.mask = size - 1
+        self.keys = np.zeros(size, dtype=np.uint64)
+        self.depths = np.zeros(size, dtype=np.int16)
+        self.used = np.zeros(size, dtype=np.bool_)
+        self.values = np.zeros((size,) + tuple(value_shape), dtype=dtype)
+
+        # Usage stats
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def lookup(self, key, depth=0):
+        """
+        Get value stored for key searched to at least depth, or None.
+        """
+        index = key & self.mask
+        if self.used[index] and self.keys[index] == np.uint64(key) and self.depths[index] >= depth:
+            self.hits += 1
+            return self.values[index].copy()
+        self.misses += 1
+        return None
+
+    def store(self, key, value, depth=0):
+        """
+        Store value for key unless its slot holds a deeper entry of another key.
+        """
+        index = key & self.mask
+        key = np.uint64(key)
+        if self.used[index] and self.keys[index] != key:
+            if self.depths[index] > depth:
+                return False
+            self.replacements += 1
+        self.keys[index] = key
+        self.depths[index] = depth
+        self.values[index] = value
+        self.used[index] = True
+        self.stores += 1
+        return True
+
+    def clear(self):
+        """
+        Drop all entries and reset stats.
+        """
+        self.used[:] = False
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def hit_rate(self):
+        """
+        Fraction of lookups answered from the table.
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.
@@ -0,0 +1,167 @@
+import random
+
+import numpy as np
+import pytest
+
+from connect4 import connect4, VecConnect4, ROWS, COLS, zobrist, P1_ZOBRIST, P2_ZOBRIST
+
+
+class ListConnect4(object):
+    """
+    The original list-of-lists board and its checkWin, kept as a reference.
+    """
+    def __init__(self):
+        self.board = [[0] * COLS for _ in range(ROWS)]
+
+    def apply_action(self, move, current_player):
+        row = ROWS - 1
+        while self.board[row][move] != 0:
+            row -= 1
+        self.board[row][move] = current_player
+        return self.checkWin(row, move, current_player)
+
+    def count(self, row, col, drow, dcol, current_player):
+        score = 0
+        while 0 <= row < ROWS and 0 <= col < COLS and self.board[row][col] == current_player:
+            score += 1
+            row += drow
+            col += dcol
+        return score
+
+    def checkWin(self, row, col, current_player):
+        for drow, dcol in ((1, 0), (0, 1), (1, 1), (1, -1)):
+            # The stone itself is counted in both directions
+            score = (self.count(row, col, drow, dcol, current_player) +
+                     self.count(row, col, -drow, -dcol, current_player) - 1)
+            if score > 3:
+                return True
+        return False
+
+
+def random_moves(rng, game):
+    return rng.choice([col for col in range(COLS) if game.legal[col]])
+
+
+def test_wins_and_ties_match_list_board():
+    rng = random.Random(0)
+    game = connect4()
+    for _ in range(2000):
+        game.reset()
+        reference = ListConnect4()
+        current_player = 1
+        terminal = False
+        while not terminal:
+            move = random_moves(rng, game)
+            win = reference.apply_action(move, current_player)
+            r_t, terminal = game.apply_action(move)
+            assert r_t == (1 if win else 0)
+            # The original checkTie ended games one stone early, a game ends
+            # on a win or the 42nd stone
+            assert terminal == (win or game.moveNum > ROWS * COLS)
+            current_player = -current_player
+
+
+def test_invalid_moves():
+    game = connect4()
+    for _ in range(ROWS):
+        assert game.apply_action(3) == (0, False)
+    assert not game.legal[3]
+    assert game.apply_action(3) == (-1, False)
+    assert game.apply_action(7) == (-1, False)
+    assert game.moveNum == ROWS + 1
+
+
+def test_pop_restores_position():
+    rng = random.Random(1)
+    game = connect4()
+    for _ in range(200):
+        game.reset()
+        positions = []
+        while not game.terminal:
+            positions.append((game.p1_bits, game.p2_bits, game.canonical_hash(), game.legal.copy()))
+            game.push(random_moves(rng, game))
+        while positions:
+            game.pop()
+            p1_bits, p2_bits, key, legal = positions.pop()
+            assert (game.p1_bits, game.p2_bits, game.canonical_hash()) == (p1_bits, p2_bits, key)
+            assert np.array_equal(game.legal, legal)
+            assert not game.terminal
+
+
+def test_push_rejects_illegal_moves():
+    game = connect4()
+    for _ in range(ROWS):
+        game.push(3)
+    position = (game.p1_bits, game.p2_bits, game.moveNum)
+    for move in (3, 7, -1):
+        with pytest.raises(ValueError):
+            game.push(move)
+        assert (game.p1_bits, game.p2_bits, game.moveNum) == position
+    # pop() takes back the last legal move
+    assert game.pop() == 3
+
+    game.reset()
+    for move in (0, 1, 0, 1, 0, 1, 0):
+        game.push(move)
+    assert game.terminal
+    with pytest.raises(ValueError):
+        game.push(2)
+    assert game.moveNum == 8
+
+
+def test_undo_restores_terminal():
+    game = connect4()
+    # vertical win in column 0, then a move played on after it
+    for move in (0, 1, 0, 1, 0, 1, 0):
+        game.apply_action(move)
+    assert game.terminal
+    game.apply_action(2)
+    game.pop()
+    assert game.terminal
+    game.pop()
+    assert not game.terminal
+
+
+def test_mirror_positions_share_canonical_hash():
+    rng = random.Random(2)
+    game = connect4()
+    mirrored = connect4()
+    for _ in range(200):
+        game.reset()
+        mirrored.reset()
+        while not game.terminal:
+            move = random_moves(rng, game)
+            game.apply_action(move)
+            mirrored.apply_action(COLS - 1 - move)
+            assert game.hash == mirrored.mirror_hash
+            assert game.canonical_hash()[0] == mirrored.canonical_hash()[0]
+
+
+def test_hash_matches_stones():
+    rng = random.Random(5)
+    game = connect4()
+    for _ in range(100):
+        game.reset()
+        while not game.terminal:
+            game.push(random_moves(rng, game))
+            assert game.hash == zobrist(game.p1_bits, P1_ZOBRIST) ^ zobrist(game.p2_bits, P2_ZOBRIST)
+        while game.moveNum > 1:
+            game.pop()
+            assert game.hash == zobrist(game.p1_bits, P1_ZOBRIST) ^ zobrist(game.p2_bits, P2_ZOBRIST)
+        assert (game.hash, game.mirror_hash) == (0, 0)
+
+
+def test_vec_matches_single_games():
+    rng = np.random.RandomState(3)
+    vec = VecConnect4(16)
+    games = [connect4() for _ in range(16)]
+    for _ in range(400):
+        actions = np.argmax(np.where(vec.legal, rng.random_sample(vec.legal.shape), -1.), axis=1)
+        _states, rewards, terminals = vec.step(actions)
+        for game, action, r_t, terminal in zip(games, actions, rewards, terminals):
+            assert game.apply_action(int(action)) == (r_t, terminal)
+            if terminal:
+                game.reset()
+        for i, game in enumerate(games):
+            assert np.array_equal(vec.boards[i, 0], game.p1_board)
+            assert np.array_equal(vec.boards[i, 1], game.p2_board)
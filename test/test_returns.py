@@ -0,0 +1,92 @@
+import numpy as np
+
+from returns import nstep_returns, nstep_targets
+
+
+def loop_targets(rewards, values, gamma):
+    """
+    One player's targets as the old per-player loop built them: the last
+    move first, then earlier moves backwards, each bootstrapping on the
+    value of the player's next move.
+    """
+    rewards = list(rewards)
+    values = list(values)
+    indices = list(range(len(rewards)))
+    targets = [(indices.pop(), rewards.pop())]
+    indices.reverse()
+    rewards.reverse()
+    values.reverse()
+    values.pop()
+    for i, r, v in zip(indices, rewards, values):
+        targets.append((i, r + gamma * v))
+    return targets
+
+
+def brute_force_targets(rewards, values, players, starts, n, gamma):
+    """
+    Sum each player's discounted rewards over its next n moves of the
+    episode one by one, plus gamma^n times the value n moves later.
+    """
+    episodes = np.cumsum(starts)
+    targets = np.zeros(len(rewards))
+    for k in range(len(rewards)):
+        later = [j for j in range(k, len(rewards))
+                 if episodes[j] == episodes[k] and players[j] == players[k]]
+        for step, j in enumerate(later[:n]):
+            targets[k] += gamma ** step * rewards[j]
+        if len(later) > n:
+            targets[k] += gamma ** n * values[later[n]]
+    return targets
+
+
+def random_batch(rng, num_episodes):
+    lengths = rng.randint(1, 43, size=num_episodes)
+    size = lengths.sum()
+    starts = np.zeros(size, dtype=bool)
+    starts[np.r_[0, np.cumsum(lengths)[:-1]]] = True
+    # Players alternate within an episode, either may move first
+    position = np.arange(size) - np.repeat(np.flatnonzero(starts), lengths)
+    players = (position + np.repeat(rng.randint(2, size=num_episodes), lengths)) % 2
+    rewards = rng.choice([-1., 0., 0., 0., 1.], size=size)
+    values = rng.randn(size)
+    actions = rng.randint(7, size=size)
+    return rewards, values, actions, players, starts
+
+
+def test_one_step_matches_loop():
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        rewards, values, actions, _players, _starts = random_batch(rng, 1)
+        # Both players' moves of an episode, one player after the other
+        split = rng.randint(1, len(rewards)) if len(rewards) > 1 else 1
+        players = (np.arange(len(rewards)) >= split).astype(int)
+        starts = np.arange(len(rewards)) == 0
+        targets, batch_a = nstep_targets(rewards, values, actions, players, starts, 1, .8)
+
+        for player in (0, 1):
+            moves = np.flatnonzero(players == player)
+            if len(moves) == 0:
+                continue
+            for i, target in loop_targets(rewards[moves], values[moves], .8):
+                assert np.isclose(targets[moves[i]], target, atol=1e-5)
+        assert np.array_equal(np.argmax(batch_a, axis=1), actions)
+
+
+def test_nstep_matches_brute_force():
+    rng = np.random.RandomState(1)
+    for n in (1, 2, 3, 5, 24):
+        for gamma in (0., .5, .8, .99, 1.):
+            for _ in range(5):
+                rewards, values, actions, players, starts = random_batch(rng, rng.randint(1, 6))
+                targets, _batch_a = nstep_targets(rewards, values, actions, players, starts, n, gamma)
+                expected = brute_force_targets(rewards, values, players, starts, n, gamma)
+                assert np.allclose(targets, expected, atol=1e-4)
+
+
+def test_nstep_returns_bootstrap_index():
+    rewards, values, _actions, players, starts = random_batch(np.random.RandomState(2), 4)
+    returns, next_index, next_discount = nstep_returns(rewards, players, starts, 2, .5)
+    bootstrapped = next_index >= 0
+    assert np.all(next_discount[bootstrapped] == .25)
+    assert np.all(next_discount[~bootstrapped] == 0)
+    assert np.all(players[next_index[bootstrapped]] == players[bootstrapped])
@@ -0,0 +1,15 @@
+import pytest
+
+from solver import Solver, game_from_moves
+
+
+def test_docstring_positions():
+    solver = Solver(16)
+    assert solver.best_move(game_from_moves("52133510205263046323")) == (4, 11)
+    assert solver.best_move(game_from_moves("6150102361340410"), weak=True) == (3, -1)
+
+
+@pytest.mark.parametrize("moves", ["38", "3a", "3-", "3333333"])
+def test_invalid_moves(moves):
+    with pytest.raises(ValueError):
+        game_from_moves(moves)